@@ -9,9 +9,16 @@ long_description = '\n\n'.join([
     ])
 
 install_requires = [
-    'redis>=2.10.5',
+    'redis>=4.1.0',
     ],
 
+aio_require = ['redis>=5.0.1']
+
+# asyncio cluster clients have pubsub since 8.0.0
+cluster_require = ['redis>=8.0.0']
+
+prometheus_require = ['prometheus_client']
+
 tests_require = ["flake8", "ipdb", "ipython", "pytest", "pytest-cov"]
 
 setup(name='turn',
@@ -27,17 +34,22 @@ setup(name='turn',
       packages=['turn'],
       include_package_data=True,
       zip_safe=False,
+      python_requires='>=3.8',
       install_requires=install_requires,
       tests_require=tests_require,
-      extras_require={'test': tests_require},
+      extras_require={'test': tests_require,
+                      'aio': aio_require,
+                      'cluster': cluster_require,
+                      'prometheus': prometheus_require},
       classifiers = [
           'Intended Audience :: Developers',
           'Programming Language :: Python',
           'Programming Language :: Python :: 3',
-          'Programming Language :: Python :: 3.3',
-          'Programming Language :: Python :: 3.4',
-          'Programming Language :: Python :: 3.5',
-          'Programming Language :: Python :: 3.6',
+          'Programming Language :: Python :: 3.8',
+          'Programming Language :: Python :: 3.9',
+          'Programming Language :: Python :: 3.10',
+          'Programming Language :: Python :: 3.11',
+          'Programming Language :: Python :: 3.12',
           'Topic :: Software Development :: Libraries :: Python Modules',
       ],
       entry_points={
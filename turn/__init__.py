@@ -2,3 +2,6 @@
 # -*- coding: utf-8 -*-
 
 from .core import Locker  # NOQA
+from .core import LockTimeout  # NOQA
+from .core import StripedLocker  # NOQA
+from .core import get_stripes  # NOQA
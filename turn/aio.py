@@ -0,0 +1,818 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Asyncio counterpart of the core module, for use in event loops. It follows
+the same protocol, so that asyncio users and threaded users can share the
+same queues. Requires the asyncio support of the redis package.
+"""
+
+import asyncio
+import collections
+import contextlib
+import heapq
+import logging
+import time
+import uuid
+
+import redis
+from redis import asyncio as aioredis
+
+from . import core
+from .core import BACKLOG
+from .core import Keys
+from .core import LockTimeout
+from .core import get_fast
+from .core import get_timeout
+from .scripts import Scripts
+
+logger = logging.getLogger(__name__)
+
+
+def is_cluster(client):
+    """ Return whether client is an asyncio Redis Cluster client. """
+    return isinstance(client, aioredis.RedisCluster)
+
+
+class Listener(object):
+    """ Receives the messages a dispatcher routes for its channels. """
+    def __init__(self, dispatcher, channels):
+        self.dispatcher = dispatcher
+        self.channels = channels
+        self.messages = asyncio.Queue()
+
+    def put(self, message):
+        self.messages.put_nowait(message)
+
+    async def listen(self, timeout=None):
+        """ Listen for messages. """
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        await self.dispatcher.unsubscribe(self)
+
+
+class Dispatcher(object):
+    """ Shares a single pubsub connection among any number of listeners. """
+    def __init__(self, client):
+        self.pubsub = client.pubsub()
+        self.listeners = {}  # channel => set of listeners
+        self.pending = {}  # channel => unacknowledged subscriptions
+        self.ready = {}  # channel => event set on acknowledgement
+        self.task = None
+        self.timeout = core.SUBSCRIBE_TIMEOUT
+
+    async def subscribe(self, *channels):
+        """ Return listener for channels, once subscribed. """
+        listener = Listener(dispatcher=self, channels=channels)
+        new = [c for c in channels if c not in self.listeners]
+        for channel in new:
+            self.listeners[channel] = set()
+            self.ready[channel] = asyncio.Event()
+            self.pending[channel] = self.pending.get(channel, 0) + 1
+        for channel in channels:
+            self.listeners[channel].add(listener)
+        ready = [self.ready[channel] for channel in channels]
+        if new:
+            try:
+                await self.pubsub.subscribe(*new)
+            except redis.RedisError:
+                self.discard(listener)
+                raise
+            if self.task is None:
+                self.task = asyncio.ensure_future(self.target())
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(event.wait() for event in ready)),
+                self.timeout,
+            )
+        except asyncio.TimeoutError:
+            await listener.close()
+            raise redis.TimeoutError(
+                'Subscribing to {} timed out.'.format(', '.join(channels)),
+            )
+        return listener
+
+    def discard(self, listener):
+        """ Remove listener and return the channels left without any. """
+        empty = []
+        for channel in listener.channels:
+            listeners = self.listeners[channel]
+            listeners.discard(listener)
+            if not listeners:
+                del self.listeners[channel]
+                del self.ready[channel]
+                self.pending.pop(channel, None)
+                empty.append(channel)
+        return empty
+
+    async def unsubscribe(self, listener):
+        """ Remove listener, unsubscribing channels it was the last one of. """
+        empty = self.discard(listener)
+        if empty:
+            await self.pubsub.unsubscribe(*empty)
+
+    async def target(self):
+        """
+        Route incoming messages to the listeners of their channel. On errors,
+        keep trying: the pubsub resubscribes its channels when it reconnects.
+        """
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1)
+            except redis.RedisError:
+                logger.exception('Receiving messages failed, retrying.')
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message['channel']
+            if message['type'] == 'subscribe':
+                # resubscriptions after reconnects are not counted
+                if self.pending.get(channel):
+                    self.pending[channel] -= 1
+                if not self.pending.get(channel):
+                    self.pending.pop(channel, None)
+                    if channel in self.ready:
+                        self.ready[channel].set()
+                continue
+            for listener in self.listeners.get(channel, ()):
+                listener.put(message)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+        await self.pubsub.aclose()
+
+
+class Heartbeat(core.Heartbeat):
+    """ Keeps any number of key-value pairs alive in redis, from a task. """
+    def __init__(self, client):
+        super(Heartbeat, self).__init__(client)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    async def add(self, key, label, expire):
+        """ Set key signaling presence and keep it alive until removed. """
+        expire = max(expire, 2)
+        await self.client.set(key, label, ex=expire)
+        self.track(key=key, expire=expire)
+
+    def track(self, key, expire):
+        """ Keep an existing key alive until removed. """
+        expire = max(expire, 2)
+        token = next(self.count)
+        self.keys[key] = expire, token
+        heapq.heappush(self.heap, (time.time() + expire - 1, key, token))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.target())
+        self.wakeup.set()
+
+    def discard(self, key):
+        """ Stop keeping key alive. """
+        self.keys.pop(key, None)
+        if len(self.heap) > 2 * len(self.keys) + 64:
+            self.compact()
+
+    async def remove(self, key):
+        """ Stop keeping key alive and revoke presence. """
+        self.discard(key)
+        await self.client.delete(key)
+
+    async def target(self):
+        """
+        Renew all due keys in a single pipeline, then sleep. Keys of a failed
+        renewal are retried soon, to keep them from expiring meanwhile.
+        """
+        while True:
+            keys = self.due()
+            if not keys:
+                timeout = self.heap[0][0] - time.time() if self.heap else None
+                self.wakeup.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                continue
+            try:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for key, expire in keys:
+                        pipe.expire(key, expire)
+                    await pipe.execute()
+            except redis.RedisError:
+                logger.exception('Renewing presence failed, retrying.')
+                self.reschedule(keys)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+
+
+class Batcher(object):
+    """ Event sink emitting events in pipelined batches, from a task. """
+    def __init__(self, client, stream=0, backlog=BACKLOG):
+        self.client = client
+        self.stream = stream
+        self.events = collections.deque(maxlen=backlog)  # (resource, text)
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __call__(self, resource, text):
+        self.events.append((resource, text))
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.target())
+        self.wakeup.set()
+
+    async def target(self):
+        """
+        Emit all pending events in a single pipeline, then sleep. Events that
+        fail to be emitted are dropped, as are the oldest beyond the backlog.
+        """
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            events = list(self.events)
+            self.events.clear()
+            try:
+                async with self.client.pipeline(transaction=False) as pipe:
+                    for resource, text in events:
+                        keys = Keys(resource, tagged=is_cluster(self.client))
+                        if self.stream:
+                            pipe.xadd(keys.events, {'event': text},
+                                      maxlen=self.stream, approximate=True)
+                        else:
+                            pipe.publish(keys.external,
+                                         '{}: {}'.format(resource, text))
+                    await pipe.execute()
+            except redis.RedisError:
+                logger.exception('Emitting events failed, dropping them.')
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+
+
+class Queue(object):
+    """ Locker initialized for specific resource. """
+    def __init__(self, client, resource, heartbeat,
+                 dispatcher, scripts, handoff=False, slots=1,
+                 shared=False, stream=0, events='all', idle=0, metrics=None,
+                 stats=0):
+        self.client = client
+        self.resource = resource
+        self.heartbeat = heartbeat
+        self.dispatcher = dispatcher
+        self.scripts = scripts
+        self.handoff = handoff
+        self.slots = slots
+        self.shared = shared
+        self.stream = stream
+        self.events = events
+        self.idle = idle
+        self.metrics = metrics
+        self.stats = stats
+        self.keys = Keys(resource, tagged=is_cluster(client))
+        self.drawn = None  # time of drawing a number or taking the resource
+        self.begun = None  # time of starting
+        self.subscription = None
+        self.commands = 0  # round trips to redis for this queue
+
+    @contextlib.asynccontextmanager
+    async def draw(self, label, expire):
+        """
+        Return a Serial number for this resource queue, after bootstrapping.
+        """
+        # draw number, signal presence and see if it is our turn already
+        expire = max(expire, 2)
+        self.drawn = time.time()
+        args = self.script_args + [label, expire,
+                                   self.slots, int(self.shared)]
+        number, started = await self.scripts.draw(
+            keys=self.script_keys, args=args,
+        )
+        self.commands += 1
+        self.started = bool(started)
+        self.echo('{} assigned to "{}"'.format(number, label))
+        if self.started:
+            self.echo('{} started'.format(number))
+
+        # keep presence alive
+        key = self.keys.key(number)
+        self.heartbeat.track(key=key, expire=expire)
+
+        try:
+            yield number
+        except BaseException:
+            if self.started:
+                await self.crash(number)
+            else:
+                await self.leave(number=number, label=label)
+            raise
+
+        # revoke presence, advance indicator and announce who may start
+        self.heartbeat.discard(key)
+        args = self.script_args + [number, label, self.slots, 'completed']
+        args += self.timings()
+        await self.scripts.release(keys=self.script_keys, args=args)
+        self.commands += 1
+        self.echo('{} completed by "{}"'.format(number, label))
+
+    async def wait(self, number, patience, timeout=None):
+        """ Waits and resets if necessary, raises LockTimeout on timeout. """
+        # started by the draw script if there was room for our number
+        if self.started:
+            return
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        # subscribe, then see if our number was announced just before; with
+        # handoff, only the channel for our own number is subscribed
+        if self.handoff:
+            channel = self.keys.handoff(number)
+        else:
+            channel = self.keys.internal
+        self.subscription = await self.dispatcher.subscribe(channel)
+        args = self.script_args + [number, self.slots]
+        started = await self.scripts.check(keys=self.script_keys, args=args)
+        self.commands += 2  # the subscription and the check
+        waiting = not started
+
+        # wait until someone announces our number
+        while waiting:
+            remaining = patience
+            if deadline is not None:
+                remaining = min(patience, deadline - time.time())
+                if remaining <= 0:
+                    raise LockTimeout(self.resource)
+            message = await self.subscription.listen(remaining)
+            if message is None:
+                if remaining < patience:
+                    continue  # deadline passed
+                # timeout beyond patience, bump and try again
+                await self.message('{} bumps'.format(number), error=True)
+                await self.bump()
+                continue
+            if message['type'] != 'message':
+                continue  # a subscribe message
+
+            waiting = self.keys.number(message['data']) != number
+
+        # our turn now
+        self.started = True
+        await self.message('{} started'.format(number))
+
+    started = core.Queue.started
+    script_keys = core.Queue.script_keys
+    script_args = core.Queue.script_args
+
+    async def message(self, text, error=False):
+        """ Public message, or event in the stream or the event sink. """
+        if callable(self.events):
+            self.events(self.resource, text)
+            return
+        if self.events == 'none' or (self.events == 'errors' and not error):
+            return
+        self.commands += 1
+        if self.stream:
+            await self.client.xadd(self.keys.events, {'event': text},
+                                   maxlen=self.stream, approximate=True)
+            return
+        await self.client.publish(self.keys.external,
+                                  '{}: {}'.format(self.resource, text))
+
+    echo = core.Queue.echo
+    timings = core.Queue.timings
+
+    async def crash(self, number):
+        """ Report the crash of a started number and revoke its presence. """
+        await self.message('{} crashed!'.format(number), error=True)
+        if self.stats:
+            await self.scripts.crash(keys=self.script_keys,
+                                     args=self.script_args)
+            self.commands += 1
+        await self.heartbeat.remove(self.keys.key(number))
+
+    async def announce(self, number):
+        """ Announce an indicator change on all channels. """
+        key = self.keys.key(number)
+        await self.client.publish(self.keys.internal, key)
+        await self.client.publish(self.keys.handoff(number), key)
+        self.commands += 2
+        await self.message('{} granted'.format(number))
+
+    async def leave(self, number, label):
+        """ Leave the queue without having started. """
+        self.heartbeat.discard(self.keys.key(number))
+        args = self.script_args + [number, label, self.slots, 'abandoned']
+        args += self.timings()
+        await self.scripts.release(keys=self.script_keys, args=args)
+        self.commands += 1
+        self.echo('{} abandoned by "{}"'.format(number, label))
+
+    async def take(self, label, expire):
+        """ Take the resource if nobody is queued, return token or None. """
+        expire = max(expire, 2)
+        token = '{}:{}'.format(uuid.uuid4().hex, label)  # label for status
+        args = self.script_args + [token, expire * 1000]
+        self.commands += 1
+        self.drawn = time.time()
+        if not await self.scripts.take(keys=self.script_keys, args=args):
+            return None
+        self.started = True
+        self.heartbeat.track(key=self.keys.fast, expire=expire)
+        return token
+
+    async def give(self, token):
+        """ Give back the resource and announce who may start. """
+        self.heartbeat.discard(self.keys.fast)
+        args = self.script_args + [token, self.slots] + self.timings()
+        await self.scripts.give(keys=self.script_keys, args=args)
+        self.commands += 1
+
+    async def bump(self):
+        """ Fix indicator in case of unnanounced departments. """
+        args = self.script_args + [self.slots]
+        number = await self.scripts.bump(keys=self.script_keys, args=args)
+        self.commands += 1
+        self.measure('bumps', 1)
+        if number is None:
+            number = await self.scan()
+        return number
+
+    async def scan(self):
+        """ Bump by scanning all numbers, for queues without an index. """
+        # read client
+        values = await self.client.mget(self.keys.indicator,
+                                        self.keys.dispenser)
+        self.commands += 2  # and the labels below
+        indicator, dispenser = map(int, values)
+
+        # determine active users
+        numbers = range(indicator, dispenser + 1)
+        keys = [self.keys.key(n) for n in numbers]
+        pairs = zip(keys, await self.client.mget(*keys))
+
+        try:
+            # determine number of first active user
+            number = next(self.keys.number(key)
+                          for key, value in pairs if value is not None)
+        except Exception:
+            # set number to next result of incr on dispenser
+            number = dispenser + 1
+
+        # set indicator to it if necessary
+        if number != indicator:
+            await self.client.set(self.keys.indicator, number)
+
+        # announce and return it anyway
+        await self.announce(number)
+        return number
+
+    measure = core.Queue.measure
+
+    async def close(self):
+        if self.subscription is not None:
+            await self.subscription.close()
+        self.measure('commands', self.commands)
+
+
+class Group(object):
+    """ Queues for several resources, drawn from and released together. """
+    def __init__(self, client, queues, heartbeat,
+                 dispatcher, scripts, handoff=False):
+        self.client = client
+        self.queues = queues
+        self.heartbeat = heartbeat
+        self.dispatcher = dispatcher
+        self.scripts = scripts
+        self.handoff = handoff
+        self.subscription = None
+
+    @contextlib.asynccontextmanager
+    async def draw(self, label, expire):
+        """
+        Return serial numbers for all queues, drawn in a single transaction.
+        """
+        # draw all numbers atomically, so that no other group can get ahead
+        # of us in one queue and behind us in another
+        expire = max(expire, 2)
+        async with self.client.pipeline() as pipe:
+            for queue in self.queues:
+                queue.drawn = time.time()
+                args = queue.script_args + [label, expire,
+                                            queue.slots, int(queue.shared)]
+                await self.scripts.draw(keys=queue.script_keys,
+                                        args=args, client=pipe)
+                queue.commands += 1
+            results = await pipe.execute()
+
+        # keep presences alive
+        numbers = []
+        for queue, (number, started) in zip(self.queues, results):
+            queue.started = bool(started)
+            queue.echo('{} assigned to "{}"'.format(number, label))
+            if queue.started:
+                queue.echo('{} started'.format(number))
+            self.heartbeat.track(key=queue.keys.key(number), expire=expire)
+            numbers.append(number)
+
+        try:
+            yield numbers
+        except BaseException:
+            for queue, number in zip(self.queues, numbers):
+                if queue.started:
+                    await queue.crash(number)
+                else:
+                    await queue.leave(number=number, label=label)
+            raise
+
+        # revoke presences, advance indicators and announce who may start
+        async with self.client.pipeline() as pipe:
+            for queue, number in zip(self.queues, numbers):
+                self.heartbeat.discard(queue.keys.key(number))
+                args = queue.script_args + [number, label, queue.slots,
+                                            'completed'] + queue.timings()
+                await self.scripts.release(keys=queue.script_keys,
+                                           args=args, client=pipe)
+                queue.commands += 1
+            await pipe.execute()
+        for queue, number in zip(self.queues, numbers):
+            queue.echo('{} completed by "{}"'.format(number, label))
+
+    async def wait(self, numbers, patience, timeout=None):
+        """
+        Waits for all numbers and resets if necessary, raises LockTimeout on
+        timeout.
+        """
+        waiting = {queue.keys.key(number): (queue, number)
+                   for queue, number in zip(self.queues, numbers)
+                   if not queue.started}
+        if not waiting:
+            return
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        # subscribe, then see which numbers were announced just before; with
+        # handoff, only the channels for our own numbers are subscribed
+        if self.handoff:
+            channels = [queue.keys.handoff(number)
+                        for queue, number in waiting.values()]
+        else:
+            channels = [queue.keys.internal
+                        for queue, number in waiting.values()]
+        self.subscription = await self.dispatcher.subscribe(*channels)
+        async with self.client.pipeline(transaction=False) as pipe:
+            for queue, number in waiting.values():
+                args = queue.script_args + [number, queue.slots]
+                await self.scripts.check(keys=queue.script_keys,
+                                         args=args, client=pipe)
+                queue.commands += 2  # the subscription and the check
+            results = await pipe.execute()
+        for key, started in zip(list(waiting), results):
+            if started:
+                queue, number = waiting.pop(key)
+                queue.started = True
+                await queue.message('{} started'.format(number))
+
+        # wait until someone announces each of our numbers
+        while waiting:
+            remaining = patience
+            if deadline is not None:
+                remaining = min(patience, deadline - time.time())
+                if remaining <= 0:
+                    raise LockTimeout(', '.join(
+                        queue.resource for queue, number in waiting.values()
+                    ))
+            message = await self.subscription.listen(remaining)
+            if message is None:
+                if remaining < patience:
+                    continue  # deadline passed
+                # timeout beyond patience, bump and try again
+                for queue, number in waiting.values():
+                    await queue.message('{} bumps'.format(number),
+                                        error=True)
+                    await queue.bump()
+                continue
+            if message['type'] != 'message':
+                continue  # a subscribe message
+
+            if message['data'] in waiting:
+                queue, number = waiting.pop(message['data'])
+                queue.started = True
+                await queue.message('{} started'.format(number))
+
+    async def close(self):
+        if self.subscription is not None:
+            await self.subscription.close()
+        for queue in self.queues:
+            await queue.close()
+
+
+class AsyncLocker(object):
+    """ Wraps an asyncio redis client. """
+    def __init__(self, handoff=False, reentrant=False, stream=0,
+                 events='all', idle=0, metrics=None, stats=0, client=None,
+                 **kwargs):
+        """
+        The kwargs are passed to the asyncio Redis instance.
+
+        :param handoff: Wake only the user whose number is announced
+        :param reentrant: Let a task lock resources it already holds
+        :param stream: Write events to a stream per resource, keeping about
+            this many, instead of publishing them
+        :param events: 'all', 'errors' or 'none' to select the events to
+            emit, 'batched' to emit all events in batches from a task, or
+            a callable receiving the resource and the text of each event
+        :param idle: Let the keys of a queue expire after it has been idle
+            for this many seconds
+        :param metrics: Callable receiving the resource, the name and the
+            value of each measurement of wait time, hold time, bumps and
+            round trips per lock
+        :param stats: Keep statistics per resource and minute in redis for
+            this many seconds
+        :param client: asyncio Redis or RedisCluster client to use instead,
+            which must decode responses
+        """
+        if client is None:
+            client = aioredis.Redis(decode_responses=True, **kwargs)
+        self.client = client
+        self.heartbeat = Heartbeat(self.client)
+        self.dispatcher = Dispatcher(self.client)
+        self.scripts = Scripts(self.client)
+        self.handoff = handoff
+        self.reentrant = reentrant
+        self.held = {}  # (task, resource) => depth
+        self.stream = stream
+        if events == 'batched':
+            events = Batcher(client=self.client, stream=stream)
+        elif not callable(events) and events not in ('all', 'errors', 'none'):
+            raise ValueError('Unknown events "{}".'.format(events))
+        self.events = events
+        self.idle = idle
+        self.metrics = metrics
+        self.stats = stats
+
+    @contextlib.asynccontextmanager
+    async def lock(self, resource, label='', expire=60, patience=60,
+                   slots=1, shared=False, timeout=None, blocking=True,
+                   mode='queue'):
+        """
+        Lock a resource.
+
+        :param resource: String corresponding to resource type
+        :param label: String label to attach
+        :param expire: int seconds
+        :param patience: int seconds
+        :param slots: int number of users allowed at the same time
+        :param shared: Allow other shared users at the same time
+        :param timeout: Seconds after which to give up with LockTimeout
+        :param blocking: Give up right away if the resource is taken
+        :param mode: 'fast' to take an idle resource without queueing
+        """
+        since = time.time()
+        timeout = get_timeout(timeout=timeout, blocking=blocking)
+        fast = get_fast(mode=mode, slots=slots, shared=shared)
+        if self.reentrant and self.holds(resource):
+            # nested in a lock on the same resource by the same task
+            with self.holding([resource], since=since):
+                yield
+            return
+
+        queue = Queue(client=self.client,
+                      resource=resource,
+                      slots=slots,
+                      shared=shared,
+                      heartbeat=self.heartbeat,
+                      dispatcher=self.dispatcher,
+                      scripts=self.scripts,
+                      handoff=self.handoff,
+                      stream=self.stream,
+                      events=self.events,
+                      idle=self.idle,
+                      metrics=self.metrics,
+                      stats=self.stats)
+        token = await queue.take(label=label, expire=expire) if fast else None
+        if token is not None:
+            try:
+                with self.holding([resource], since=since):
+                    yield
+            finally:
+                await queue.give(token)
+                await queue.close()
+            return
+
+        try:
+            async with queue.draw(label=label, expire=expire) as number:
+                await queue.wait(number=number, patience=patience,
+                                 timeout=timeout)
+                with self.holding([resource], since=since):
+                    yield
+        finally:
+            await queue.close()
+
+    def holds(self, resource):
+        """ Return whether the current task holds a lock on resource. """
+        return (asyncio.current_task(), resource) in self.held
+
+    @contextlib.contextmanager
+    def holding(self, resources, since):
+        """
+        Count resources as held by the current task, measuring the time
+        waited since given time and the time held.
+        """
+        start = time.time()
+        for resource in resources:
+            self.measure(resource, 'wait', start - since)
+        task = asyncio.current_task()
+        keys = [(task, resource) for resource in resources]
+        for key in keys:
+            self.held[key] = self.held.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            for key in keys:
+                self.held[key] -= 1
+                if not self.held[key]:
+                    del self.held[key]
+            for resource in resources:
+                self.measure(resource, 'hold', time.time() - start)
+
+    measure = core.Locker.measure
+
+    @contextlib.asynccontextmanager
+    async def lock_many(self, resources, label='', expire=60, patience=60,
+                        slots=1, shared=False, timeout=None, blocking=True):
+        """
+        Lock several resources at once, releasing them together.
+
+        :param resources: Strings corresponding to resource types
+        :param label: String label to attach
+        :param expire: int seconds
+        :param patience: int seconds
+        :param slots: int number of users allowed at the same time
+        :param shared: Allow other shared users at the same time
+        :param timeout: Seconds after which to give up with LockTimeout
+        :param blocking: Give up right away if a resource is taken
+        """
+        since = time.time()
+        timeout = get_timeout(timeout=timeout, blocking=blocking)
+        resources = sorted(set(resources))
+        if is_cluster(self.client):
+            # a transaction cannot span the slots of several resources
+            deadline = None if timeout is None else time.time() + timeout
+            async with contextlib.AsyncExitStack() as stack:
+                for resource in resources:
+                    if deadline is not None:
+                        timeout = max(0, deadline - time.time())
+                    await stack.enter_async_context(self.lock(
+                        resource=resource, label=label, expire=expire,
+                        patience=patience, slots=slots, shared=shared,
+                        timeout=timeout,
+                    ))
+                yield
+            return
+
+        queues = [Queue(client=self.client,
+                        resource=resource,
+                        slots=slots,
+                        shared=shared,
+                        heartbeat=self.heartbeat,
+                        dispatcher=self.dispatcher,
+                        scripts=self.scripts,
+                        handoff=self.handoff,
+                        stream=self.stream,
+                        events=self.events,
+                        idle=self.idle,
+                        metrics=self.metrics,
+                        stats=self.stats)
+                  for resource in resources
+                  if not (self.reentrant and self.holds(resource))]
+        group = Group(client=self.client,
+                      queues=queues,
+                      heartbeat=self.heartbeat,
+                      dispatcher=self.dispatcher,
+                      scripts=self.scripts,
+                      handoff=self.handoff)
+        try:
+            async with group.draw(label=label, expire=expire) as numbers:
+                await group.wait(numbers=numbers, patience=patience,
+                                 timeout=timeout)
+                with self.holding(resources, since=since):
+                    yield
+        finally:
+            await group.close()
+
+    async def close(self):
+        """ Stop background tasks and close connections. """
+        if isinstance(self.events, Batcher):
+            await self.events.close()
+        await self.heartbeat.close()
+        await self.dispatcher.close()
+        await self.client.aclose()
@@ -0,0 +1,299 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for lock throughput, handoff latency and the cost of bumps, run
+against a redis server that is not in use otherwise. Results are printed or
+written as JSON, so that results of releases can be compared.
+
+python -m turn.benchmark --host localhost --output results.json
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import platform
+import sys
+import threading
+import time
+
+import redis
+
+from .core import Heartbeat
+from .core import Keys
+from .core import Locker
+from .core import Queue
+
+PREFIX = 'benchmark'  # prefix for the resources used by the benchmarks
+
+
+# helpers
+def get_locker(kwargs, **options):
+    """ Return a locker with a client of its own. """
+    client = redis.Redis(decode_responses=True, **kwargs)
+    return Locker(client=client, **options)
+
+
+def cleanup(client, resources):
+    """ Remove all keys of resources. """
+    for resource in resources:
+        keys = Keys(resource)
+        client.delete(keys.dispenser, keys.indicator, keys.index,
+                      keys.exclusive, keys.fast, keys.events)
+        client.srem(Keys.RESOURCES, resource)
+
+
+def percentile(values, fraction):
+    """ Return the value below which fraction of sorted values fall. """
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize(values):
+    """ Return mean, median and 95th percentile of values in seconds. """
+    values = sorted(values)
+    if not values:
+        return {'mean': None, 'p50': None, 'p95': None}
+    return {'mean': sum(values) / len(values),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95)}
+
+
+def handoffs(intervals):
+    """ Return the gaps between consecutive (start, end) intervals. """
+    intervals = sorted(intervals)
+    return [start - end
+            for (_, end), (start, _) in zip(intervals, intervals[1:])]
+
+
+def cycles(locker, resource, count, **kwargs):
+    """
+    Lock resource count times, return the intervals from starting until
+    releasing.
+    """
+    intervals = []
+    for _ in range(count):
+        with locker.lock(resource=resource, label=PREFIX, **kwargs):
+            intervals.append((time.time(), time.time()))
+    return intervals
+
+
+def work(kwargs, resource, count):
+    """ Lock resource count times in another process. """
+    return cycles(get_locker(kwargs), resource, count)
+
+
+# benchmarks
+def uncontended(kwargs, count, mode='queue'):
+    """ Lock and release a resource nobody else uses. """
+    locker = get_locker(kwargs)
+    resource = '{}_uncontended_{}'.format(PREFIX, mode)
+    cycles(locker, resource, 10, mode=mode)  # warm up
+
+    start = time.time()
+    for _ in range(count):
+        with locker.lock(resource=resource, label=PREFIX, mode=mode):
+            pass
+    duration = time.time() - start
+
+    cleanup(locker.client, [resource])
+    return {'cycles': count,
+            'locks_per_second': count / duration,
+            'seconds_per_cycle': duration / count}
+
+
+def threads(kwargs, count, users, handoff=False):
+    """ Lock a single resource from many threads of one process. """
+    locker = get_locker(kwargs, handoff=handoff)
+    resource = '{}_threads'.format(PREFIX)
+    results = []
+
+    def target():
+        results.extend(cycles(locker, resource, count))
+
+    workers = [threading.Thread(target=target) for _ in range(users)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+
+    cleanup(locker.client, [resource])
+    return {'threads': users,
+            'cycles': count * users,
+            'handoff': handoff,
+            'locks_per_second': count * users / duration,
+            'handoff_seconds': summarize(handoffs(results))}
+
+
+def processes(kwargs, count, users):
+    """ Lock a single resource from many processes. """
+    resource = '{}_processes'.format(PREFIX)
+    pool = multiprocessing.Pool(users)
+    start = time.time()
+    try:
+        results = pool.starmap(work, [(kwargs, resource, count)] * users)
+    finally:
+        pool.close()
+        pool.join()
+    duration = time.time() - start
+
+    cleanup(redis.Redis(decode_responses=True, **kwargs), [resource])
+    intervals = [interval for result in results for interval in result]
+    return {'processes': users,
+            'cycles': count * users,
+            'locks_per_second': count * users / duration,
+            'handoff_seconds': summarize(handoffs(intervals))}
+
+
+def parallel(kwargs, count, users):
+    """ Lock a resource per thread, all threads sharing one locker. """
+    locker = get_locker(kwargs)
+    resources = ['{}_parallel_{}'.format(PREFIX, n) for n in range(users)]
+    workers = [threading.Thread(target=cycles, args=(locker, r, count))
+               for r in resources]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    duration = time.time() - start
+
+    cleanup(locker.client, resources)
+    return {'resources': users,
+            'cycles': count * users,
+            'locks_per_second': count * users / duration}
+
+
+def bumps(kwargs, depths, repeat=5):
+    """
+    Time a bump of a queue of given depths, with every user present and
+    with every user but the last one gone.
+    """
+    client = redis.Redis(decode_responses=True, **kwargs)
+    heartbeat = Heartbeat(client)
+    resource = '{}_bumps'.format(PREFIX)
+    results = []
+    for depth in depths:
+        timings = {'present': [], 'gone': []}
+        for _ in range(repeat):
+            for case, times in timings.items():
+                queue = Queue(client=client, resource=resource,
+                              heartbeat=heartbeat, events='none')
+                with contextlib.ExitStack() as stack:
+                    numbers = [stack.enter_context(
+                        queue.draw(label=PREFIX, expire=60),
+                    ) for _ in range(depth)]
+                    if case == 'gone':
+                        client.delete(*map(queue.keys.key, numbers[:-1]))
+                    start = time.time()
+                    queue.bump()
+                    times.append(time.time() - start)
+                queue.close()
+        results.append({'depth': depth,
+                        'present_seconds': summarize(timings['present']),
+                        'gone_seconds': summarize(timings['gone'])})
+    cleanup(client, [resource])
+    return results
+
+
+def commands(kwargs, count):
+    """
+    Count round trips per cycle as reported by the metrics of a locker, and
+    commands per cycle as counted by the server, including the commands of
+    the scripts, uncontended.
+    """
+    trips = []
+
+    def measure(resource, name, value):
+        if name == 'commands':
+            trips.append(value)
+
+    locker = get_locker(kwargs, metrics=measure)
+    resource = '{}_commands'.format(PREFIX)
+    cycles(locker, resource, 10)  # warm up
+
+    result = {}
+    for events in ('all', 'none'):
+        locker.events = events
+        del trips[:]
+        before = locker.client.info('stats')['total_commands_processed']
+        cycles(locker, resource, count)
+        after = locker.client.info('stats')['total_commands_processed']
+        result[events] = {
+            'round_trips_per_cycle': sum(trips) / count,
+            'server_commands_per_cycle': (after - before) / count,
+        }
+
+    cleanup(locker.client, [resource])
+    return result
+
+
+def run(kwargs, count=1000, users=8, depths=(10, 100, 1000)):
+    """ Return the results of all benchmarks, with some context. """
+    client = redis.Redis(decode_responses=True, **kwargs)
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'redis_py': redis.__version__,
+        'redis': client.info('server')['redis_version'],
+        'parameters': {'cycles': count, 'users': users,
+                       'depths': list(depths)},
+    }
+    per_user = max(count // users, 1)
+    results['uncontended'] = uncontended(kwargs, count)
+    results['uncontended_fast'] = uncontended(kwargs, count, mode='fast')
+    results['threads'] = threads(kwargs, per_user, users)
+    results['threads_handoff'] = threads(kwargs, per_user, users,
+                                         handoff=True)
+    results['processes'] = processes(kwargs, per_user, users)
+    results['parallel'] = parallel(kwargs, per_user, users)
+    results['bumps'] = bumps(kwargs, depths)
+    results['commands'] = commands(kwargs, min(count, 100))
+    return results
+
+
+def get_parser():
+    """ Return argument parser. """
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__,
+    )
+
+    # connection to redis server
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', default=6379, type=int)
+    parser.add_argument('--db', default=0, type=int)
+    parser.add_argument('--password')
+
+    # benchmarks
+    parser.add_argument('--cycles', default=1000, type=int,
+                        help='number of locks per benchmark')
+    parser.add_argument('--users', default=8, type=int,
+                        help='number of contending threads or processes')
+    parser.add_argument('--depths', default=[10, 100, 1000], type=int,
+                        nargs='+', help='queue depths for bumps')
+    parser.add_argument('--output', help='file to write the results to')
+    return parser
+
+
+def main():
+    """ Run benchmarks with args from parser and write the results. """
+    kwargs = vars(get_parser().parse_args())
+    output = kwargs.pop('output')
+    results = run(count=kwargs.pop('cycles'),
+                  users=kwargs.pop('users'),
+                  depths=kwargs.pop('depths'),
+                  kwargs=kwargs)
+    if output is None:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
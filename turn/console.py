@@ -5,7 +5,23 @@ turn follow
    print queue activity for all existing resources
 
 turn follow RESOURCE [RESOURCE ...]
-   print queue activity for given resources
+   print queue activity for given resources, which may be glob patterns
+
+turn follow --json [RESOURCE ...]
+   print queue activity as JSON lines
+
+turn follow --stream [RESOURCE ...]
+   print queue activity from event streams, starting with the oldest events
+
+turn gc
+   remove queues that nobody uses, for all existing resources
+
+turn gc RESOURCE [RESOURCE ...]
+   remove queues that nobody uses, for given resources
+
+turn gc --scan
+   remove queues that nobody uses, also for resources missing from the
+   registry, registering them
 
 turn lock
    lock all existing resources
@@ -13,12 +29,24 @@ turn lock
 turn lock RESOURCE [RESOURCE ...]
    lock given resources
 
+turn recover
+    bump queues when the presence of a user expires, for all resources
+
+turn recover RESOURCE [RESOURCE ...]
+    bump queues when the presence of a user expires, for given resources
+
 turn status
     print queue summary for all existing resources
 
 turn status RESOURCE [RESOURCE ...]
     print queue details for given resources
 
+turn status --json [RESOURCE ...]
+    print queue summary or details as JSON lines
+
+turn status --stats [RESOURCE ...]
+    print lock statistics of the last hour, kept by lockers with stats
+
 turn reset
     try bump & reset on all existing resources
 
@@ -29,6 +57,13 @@ import argparse
 
 from . import tools
 
+OPTIONS = {
+    'json': ('follow', 'status'),
+    'stream': ('follow',),
+    'stats': ('status',),
+    'scan': ('gc', 'lock', 'reset', 'status'),
+}
+
 
 def command(command, resources, *args, **kwargs):
     return getattr(tools, command)(resources, *args, **kwargs)
@@ -46,15 +81,41 @@ def get_parser():
     parser.add_argument('--port', default=6379, type=int)
     parser.add_argument('--db', default=0, type=int)
     parser.add_argument('--password')
+    parser.add_argument('--cluster', action='store_true',
+                        default=argparse.SUPPRESS,
+                        help='connect to a Redis Cluster')
 
     # tools
-    parser.add_argument('command', choices=(str('follow'), str('lock'),
+    parser.add_argument('command', choices=(str('follow'), str('gc'),
+                                            str('lock'), str('recover'),
                                             str('reset'), str('status')))
     parser.add_argument('resources', nargs='*', metavar='RESOURCE')
 
+    # options
+    parser.add_argument('--json', action='store_true',
+                        default=argparse.SUPPRESS,
+                        help='print JSON lines (follow and status only)')
+    parser.add_argument('--stream', action='store_true',
+                        default=argparse.SUPPRESS,
+                        help='read event streams (follow only)')
+    parser.add_argument('--stats', action='store_true',
+                        default=argparse.SUPPRESS,
+                        help='print lock statistics (status only)')
+    parser.add_argument('--scan', action='store_true',
+                        default=argparse.SUPPRESS,
+                        help='scan for unregistered resources '
+                             '(gc, lock, reset and status only)')
+
     return parser
 
 
 def main():
     """ Call command with args from parser. """
-    return command(**vars(get_parser().parse_args()))
+    parser = get_parser()
+    kwargs = vars(parser.parse_args())
+    for option, commands in OPTIONS.items():
+        if option in kwargs and kwargs['command'] not in commands:
+            parser.error('--{} is not supported by {}'.format(
+                option, kwargs['command'],
+            ))
+    return command(**kwargs)
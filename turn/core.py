@@ -1,14 +1,67 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
 # -*- coding: utf-8 -*-
 
+import collections
 import contextlib
 import hashlib
+import heapq
+import itertools
+import logging
+import math
 import re
+import sys
 import threading
+import time
+import uuid
 
 import redis
 
+from .scripts import Scripts
+
 PREFIX = 'turn'  # prefix for all redis keys
+SUBSCRIBE_TIMEOUT = 10  # seconds to wait for acknowledgement of subscribing
+BACKLOG = 10000  # events waiting to be emitted, beyond which the oldest go
+
+logger = logging.getLogger(__name__)
+
+
+class LockTimeout(Exception):
+    """ Raised when a lock is not acquired in time. """
+
+
+def get_timeout(timeout, blocking):
+    """ Return timeout for waiting, zero when not blocking. """
+    if blocking:
+        return timeout
+    if timeout is not None:
+        raise ValueError('A timeout requires blocking to be True.')
+    return 0
+
+
+def get_fast(mode, slots, shared):
+    """ Return whether to take the resource in fast mode. """
+    if mode not in ('queue', 'fast'):
+        raise ValueError('Unknown mode "{}".'.format(mode))
+    if mode == 'fast' and (slots != 1 or shared):
+        raise ValueError('Fast mode requires exclusive use.')
+    return mode == 'fast'
+
+
+def get_stripes(users, rate):
+    """
+    Return the number of stripes for which a lock collides with one of the
+    other concurrent users at about the given rate.
+    """
+    if not 0 < rate < 1:
+        raise ValueError('A rate must lie between 0 and 1.')
+    if users < 2:
+        return 1
+    return int(math.ceil(1 / (1 - (1 - rate) ** (1 / (users - 1)))))
+
+
+def is_cluster(client):
+    """ Return whether client is a Redis Cluster client. """
+    return isinstance(client, redis.RedisCluster)
 
 
 class Keys(object):
@@ -16,29 +69,70 @@ class Keys(object):
     # values
     DISPENSER = '{}:{{}}:dispenser'.format(PREFIX)
     INDICATOR = '{}:{{}}:indicator'.format(PREFIX)
+    INDEX = '{}:{{}}:index'.format(PREFIX)
+    EXCLUSIVE = '{}:{{}}:exclusive'.format(PREFIX)
+    FAST = '{}:{{}}:fast'.format(PREFIX)
+    EVENTS = '{}:{{}}:events'.format(PREFIX)
+    STATS = '{}:{{}}:stats:{{}}'.format(PREFIX)  # statistics per minute
+    RESOURCES = '{}:resources'.format(PREFIX)  # registry of all resources
     NUMBER = '{}:{{}}:serial:{{}}'.format(PREFIX)  # used as message, too
 
     # channels
     INTERNAL = '{}:{{}}:internal'.format(PREFIX)
     EXTERNAL = '{}:{{}}:external'.format(PREFIX)
+    HANDOFF = '{}:{{}}:handoff:{{}}'.format(PREFIX)
 
-    def __init__(self, resource):
+    def __init__(self, resource, tagged=False):
+        """
+        :param tagged: Put the resource in a hash tag, so that all keys of
+            the resource map to the same slot of a Redis Cluster
+        """
         self.resource = resource
-        self.internal = self.INTERNAL.format(resource)
-        self.external = self.EXTERNAL.format(resource)
-        self.dispenser = self.DISPENSER.format(resource)
-        self.indicator = self.INDICATOR.format(resource)
+        self.tag = self.hashtag(resource) if tagged else resource
+        self.internal = self.INTERNAL.format(self.tag)
+        self.external = self.EXTERNAL.format(self.tag)
+        self.dispenser = self.DISPENSER.format(self.tag)
+        self.indicator = self.INDICATOR.format(self.tag)
+        self.index = self.INDEX.format(self.tag)
+        self.exclusive = self.EXCLUSIVE.format(self.tag)
+        self.fast = self.FAST.format(self.tag)
+        self.events = self.EVENTS.format(self.tag)
+
+        # a registry would map to another slot than the keys of the resource
+        self.registry = None if tagged else self.RESOURCES
 
-        self.pattern = re.compile(self.NUMBER.format(self.resource, '(.*)'))
+        self.pattern = re.compile(
+            self.NUMBER.format(re.escape(self.tag), '(.*)'),
+        )
+
+    @staticmethod
+    def hashtag(resource):
+        """ Return resource as hash tag. """
+        return '{{{}}}'.format(resource)
+
+    @staticmethod
+    def untag(tag):
+        """ Return resource from the part of a key that may be a hash tag. """
+        if tag.startswith('{') and tag.endswith('}'):
+            return tag[1:-1]
+        return tag
 
     def key(self, number):
         """ Return key for a number. """
-        return self.NUMBER.format(self.resource, number)
+        return self.NUMBER.format(self.tag, number)
 
     def number(self, key):
         """ Return number for a key. """
         return int(self.pattern.match(key).group(1))
 
+    def handoff(self, number):
+        """ Return handoff channel for a number. """
+        return self.HANDOFF.format(self.tag, number)
+
+    def stats(self, minute):
+        """ Return key for the statistics of a minute. """
+        return self.STATS.format(self.tag, minute)
+
 
 class Subscription(object):
     def __init__(self, client, *channels):
@@ -54,83 +148,399 @@ class Subscription(object):
         self.pubsub.close()
 
 
-class Keeper(object):
-    """ Keeps key-value pair alive in redis. """
-    def __init__(self, **kwargs):
-        self.thread = threading.Thread(target=self.target, kwargs=kwargs)
-        self.leave = threading.Event()
-        self.thread.start()
+class Listener(object):
+    """ Receives the messages a dispatcher routes for its channels. """
+    def __init__(self, dispatcher, channels):
+        self.dispatcher = dispatcher
+        self.channels = channels
+        self.messages = collections.deque()
+        self.condition = threading.Condition()
+
+    def put(self, message):
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify()
+
+    def listen(self, timeout=None):
+        """ Listen for messages. """
+        with self.condition:
+            self.condition.wait_for(lambda: self.messages, timeout=timeout)
+            return self.messages.popleft() if self.messages else None
 
-    def target(self, client, key, label, expire):
-        # set key signaling this number is active
+    def close(self):
+        self.dispatcher.unsubscribe(self)
+
+
+class Dispatcher(object):
+    """ Shares a single pubsub connection among any number of listeners. """
+    def __init__(self, client):
+        self.pubsub = client.pubsub()
+        self.listeners = {}  # channel => set of listeners
+        self.pending = collections.Counter()  # channel => unacknowledged
+        self.ready = {}  # channel => event set on acknowledgement
+        self.lock = threading.Lock()
+        self.thread = None
+        self.timeout = SUBSCRIBE_TIMEOUT
+        self.closed = False
+
+    def subscribe(self, *channels):
+        """ Return listener for channels, once subscribed. """
+        listener = Listener(dispatcher=self, channels=channels)
+        with self.lock:
+            new = [c for c in channels if c not in self.listeners]
+            for channel in new:
+                self.listeners[channel] = set()
+                self.ready[channel] = threading.Event()
+                self.pending[channel] += 1
+            for channel in channels:
+                self.listeners[channel].add(listener)
+            ready = [self.ready[channel] for channel in channels]
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.target)
+                self.thread.daemon = True
+                self.thread.start()
+            if new:
+                try:
+                    self.pubsub.subscribe(*new)
+                except redis.RedisError:
+                    self.discard(listener)
+                    raise
+        deadline = time.time() + self.timeout
+        for event in ready:
+            if not event.wait(timeout=max(deadline - time.time(), 0)):
+                listener.close()
+                raise redis.TimeoutError(
+                    'Subscribing to {} timed out.'.format(', '.join(channels)),
+                )
+        return listener
+
+    def discard(self, listener):
+        """ Remove listener and return the channels left without any. """
+        empty = []
+        for channel in listener.channels:
+            listeners = self.listeners[channel]
+            listeners.discard(listener)
+            if not listeners:
+                del self.listeners[channel]
+                del self.ready[channel]
+                self.pending.pop(channel, None)
+                empty.append(channel)
+        return empty
+
+    def unsubscribe(self, listener):
+        """ Remove listener, unsubscribing channels it was the last one of. """
+        with self.lock:
+            empty = self.discard(listener)
+            if empty:
+                self.pubsub.unsubscribe(*empty)
+
+    def target(self):
+        """
+        Route incoming messages to the listeners of their channel. On errors,
+        keep trying: the pubsub resubscribes its channels when it reconnects.
+        """
+        while not self.closed:
+            try:
+                message = self.pubsub.get_message(timeout=1)
+            except redis.RedisError:
+                logger.exception('Receiving messages failed, retrying.')
+                time.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message['channel']
+            with self.lock:
+                if message['type'] == 'subscribe':
+                    # resubscriptions after reconnects are not counted
+                    if self.pending[channel]:
+                        self.pending[channel] -= 1
+                    if not self.pending[channel]:
+                        del self.pending[channel]
+                        if channel in self.ready:
+                            self.ready[channel].set()
+                    continue
+                for listener in self.listeners.get(channel, ()):
+                    listener.put(message)
+
+    def close(self):
+        """ Stop the thread and close the pubsub connection. """
+        self.closed = True
+        if self.thread is not None:
+            self.thread.join()
+        self.pubsub.close()
+
+
+class Heartbeat(object):
+    """ Keeps any number of key-value pairs alive in redis. """
+    def __init__(self, client):
+        self.client = client
+        self.heap = []  # (deadline, key, token) tuples
+        self.keys = {}  # key => (expire, token)
+        self.count = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def add(self, key, label, expire):
+        """ Set key signaling presence and keep it alive until removed. """
+        expire = max(expire, 2)
+        self.client.set(key, label, ex=expire)
+        self.track(key=key, expire=expire)
+
+    def track(self, key, expire):
+        """ Keep an existing key alive until removed. """
         expire = max(expire, 2)
-        client.set(key, label, ex=expire)
+        token = next(self.count)
+        with self.condition:
+            self.keys[key] = expire, token
+            heapq.heappush(self.heap, (time.time() + expire - 1, key, token))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.target)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def discard(self, key):
+        """ Stop keeping key alive. """
+        with self.condition:
+            self.keys.pop(key, None)
+            if len(self.heap) > 2 * len(self.keys) + 64:
+                self.compact()
+
+    def remove(self, key):
+        """ Stop keeping key alive and revoke presence. """
+        self.discard(key)
+        self.client.delete(key)
 
-        # keep key alive
+    def compact(self):
+        """ Drop heap entries for keys that are no longer kept alive. """
+        self.heap = [(deadline, key, token)
+                     for deadline, key, token in self.heap
+                     if self.keys.get(key, (None, None))[1] == token]
+        heapq.heapify(self.heap)
+
+    def due(self):
+        """ Pop and return keys that need renewal within half a second. """
+        keys = []
+        horizon = time.time() + 0.5
+        while self.heap and self.heap[0][0] <= horizon:
+            deadline, key, token = heapq.heappop(self.heap)
+            if self.keys.get(key, (None, None))[1] != token:
+                continue  # removed or added again in the mean time
+            expire = self.keys[key][0]
+            heapq.heappush(self.heap, (time.time() + expire - 1, key, token))
+            keys.append((key, expire))
+        return keys
+
+    def reschedule(self, keys):
+        """
+        Renew keys again in less than a second, the least time they have left
+        when renewed, superseding their schedule.
+        """
+        for key, expire in keys:
+            if key not in self.keys:
+                continue  # removed in the mean time
+            token = next(self.count)
+            self.keys[key] = expire, token
+            heapq.heappush(self.heap, (time.time() + 0.75, key, token))
+        if len(self.heap) > 2 * len(self.keys) + 64:
+            self.compact()
+
+    def target(self):
+        """
+        Renew all due keys in a single pipeline, then sleep. Keys of a failed
+        renewal are retried soon, to keep them from expiring meanwhile.
+        """
         while True:
-            client.expire(key, time=expire)
-            if self.leave.wait(timeout=expire - 1):
-                break
+            with self.condition:
+                if self.closed:
+                    return
+                keys = self.due()
+                if not keys:
+                    if self.heap:
+                        timeout = self.heap[0][0] - time.time()
+                    else:
+                        timeout = None
+                    self.condition.wait(timeout=timeout)
+                    continue
+            try:
+                with self.client.pipeline(transaction=False) as pipe:
+                    for key, expire in keys:
+                        pipe.expire(key, expire)
+                    pipe.execute()
+            except redis.RedisError:
+                logger.exception('Renewing presence failed, retrying.')
+                with self.condition:
+                    self.reschedule(keys)
+
+    def close(self):
+        """ Stop the thread, leaving keys to expire. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class Batcher(object):
+    """ Event sink emitting events in pipelined batches, from a thread. """
+    def __init__(self, client, stream=0, backlog=BACKLOG):
+        self.client = client
+        self.stream = stream
+        self.events = collections.deque(maxlen=backlog)  # (resource, text)
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
 
-        # revoke presence
-        client.delete(key)
+    def __call__(self, resource, text):
+        with self.condition:
+            self.events.append((resource, text))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.target)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def target(self):
+        """
+        Emit all pending events in a single pipeline, then sleep. Events that
+        fail to be emitted are dropped, as are the oldest beyond the backlog.
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.events or self.closed)
+                if not self.events:
+                    return
+                events = list(self.events)
+                self.events.clear()
+            try:
+                with self.client.pipeline(transaction=False) as pipe:
+                    for resource, text in events:
+                        keys = Keys(resource, tagged=is_cluster(self.client))
+                        if self.stream:
+                            pipe.xadd(keys.events, {'event': text},
+                                      maxlen=self.stream, approximate=True)
+                        else:
+                            pipe.publish(keys.external,
+                                         '{}: {}'.format(resource, text))
+                    pipe.execute()
+            except redis.RedisError:
+                logger.exception('Emitting events failed, dropping them.')
+                time.sleep(1)
 
     def close(self):
-        """ Start and return thread. """
-        self.leave.set()
-        self.thread.join()
+        """ Stop the thread, after emitting the pending events. """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
 
 
 class Queue(object):
     """ Locker initialized for specific resource. """
-    def __init__(self, client, resource):
+    def __init__(self, client, resource, heartbeat=None,
+                 dispatcher=None, scripts=None, handoff=False, slots=1,
+                 shared=False, stream=0, events='all', idle=0, metrics=None,
+                 stats=0):
         self.client = client
         self.resource = resource
-        self.keys = Keys(resource)
-        self.subscription = Subscription(self.client, self.keys.internal)
+        self.heartbeat = heartbeat or Heartbeat(client)
+        self.dispatcher = dispatcher
+        self.scripts = scripts or Scripts(client)
+        self.handoff = handoff
+        self.slots = slots
+        self.shared = shared
+        self.stream = stream
+        self.events = events
+        self.idle = idle
+        self.metrics = metrics
+        self.stats = stats
+        self.keys = Keys(resource, tagged=is_cluster(client))
+        self.drawn = None  # time of drawing a number or taking the resource
+        self.begun = None  # time of starting
+        self.subscription = None
+        self.commands = 0  # round trips to redis for this queue
+
+    def subscribe(self, channel):
+        """ Return subscription to channel. """
+        self.commands += 1
+        if self.dispatcher is None:
+            return Subscription(self.client, channel)
+        return self.dispatcher.subscribe(channel)
 
     @contextlib.contextmanager
     def draw(self, label, expire):
         """
         Return a Serial number for this resource queue, after bootstrapping.
         """
-        # get next number
-        with self.client.pipeline() as pipe:
-            pipe.msetnx({self.keys.dispenser: 0, self.keys.indicator: 1})
-            pipe.incr(self.keys.dispenser)
-            number = pipe.execute()[-1]
-
-        # publish for humans
-        self.message('{} assigned to "{}"'.format(number, label))
+        # draw number, signal presence and see if it is our turn already
+        expire = max(expire, 2)
+        self.drawn = time.time()
+        args = self.script_args + [label, expire,
+                                   self.slots, int(self.shared)]
+        number, started = self.scripts.draw(keys=self.script_keys,
+                                            args=args)
+        self.commands += 1
+        self.started = bool(started)
+        self.echo('{} assigned to "{}"'.format(number, label))
+        if self.started:
+            self.echo('{} started'.format(number))
 
-        # launch keeper
-        kwargs = {'client': self.client, 'key': self.keys.key(number)}
-        keeper = Keeper(label=label, expire=expire, **kwargs)
+        # keep presence alive
+        key = self.keys.key(number)
+        self.heartbeat.track(key=key, expire=expire)
 
         try:
             yield number
-        except Exception:
-            self.message('{} crashed!'.format(number))
+        except BaseException:
+            if self.started:
+                self.crash(number)
+            else:
+                self.leave(number=number, label=label)
             raise
-        finally:
-            keeper.close()
 
-        self.message('{} completed by "{}"'.format(number, label))
-        number += 1
-        self.client.set(self.keys.indicator, number)
-        self.announce(number)
+        # revoke presence, advance indicator and announce who may start
+        self.heartbeat.discard(key)
+        args = self.script_args + [number, label, self.slots, 'completed']
+        args += self.timings()
+        self.scripts.release(keys=self.script_keys, args=args)
+        self.commands += 1
+        self.echo('{} completed by "{}"'.format(number, label))
+
+    def wait(self, number, patience, timeout=None):
+        """ Waits and resets if necessary, raises LockTimeout on timeout. """
+        # started by the draw script if there was room for our number
+        if self.started:
+            return
 
-    def wait(self, number, patience):
-        """ Waits and resets if necessary. """
-        # inspect indicator for our number
-        waiting = int(self.client.get(self.keys.indicator)) != number
+        deadline = None if timeout is None else time.time() + timeout
+
+        # subscribe, then see if our number was announced just before; with
+        # handoff, only the channel for our own number is subscribed
+        if self.handoff:
+            channel = self.keys.handoff(number)
+        else:
+            channel = self.keys.internal
+        self.subscription = self.subscribe(channel)
+        args = self.script_args + [number, self.slots]
+        started = self.scripts.check(keys=self.script_keys, args=args)
+        self.commands += 1
+        waiting = not started
 
         # wait until someone announces our number
         while waiting:
-            message = self.subscription.listen(patience)
+            remaining = patience
+            if deadline is not None:
+                remaining = min(patience, deadline - time.time())
+                if remaining <= 0:
+                    raise LockTimeout(self.resource)
+            message = self.subscription.listen(remaining)
             if message is None:
+                if remaining < patience:
+                    continue  # deadline passed
                 # timeout beyond patience, bump and try again
-                self.message('{} bumps'.format(number))
+                self.message('{} bumps'.format(number), error=True)
                 self.bump()
                 continue
             if message['type'] != 'message':
@@ -139,22 +549,129 @@ class Queue(object):
             waiting = self.keys.number(message['data']) != number
 
         # our turn now
+        self.started = True
         self.message('{} started'.format(number))
 
-    def message(self, text):
-        """ Public message. """
+    @property
+    def started(self):
+        """ Whether our number started, or the resource was taken. """
+        return self.begun is not None
+
+    @started.setter
+    def started(self, value):
+        self.begun = time.time() if value else None
+
+    @property
+    def script_keys(self):
+        """ Keys for the scripts. """
+        return [self.keys.dispenser,
+                self.keys.indicator,
+                self.keys.index,
+                self.keys.exclusive,
+                self.keys.fast,
+                self.keys.registry or self.keys.dispenser,
+                self.keys.events]
+
+    @property
+    def script_args(self):
+        """ Leading arguments for the scripts. """
+        return [self.resource,
+                self.keys.internal,
+                self.keys.external,
+                self.keys.key(''),
+                self.keys.handoff(''),
+                self.stream,
+                int(self.events == 'all'),
+                self.idle,
+                self.keys.stats(''),
+                self.stats]
+
+    def message(self, text, error=False):
+        """ Public message, or event in the stream or the event sink. """
+        if callable(self.events):
+            self.events(self.resource, text)
+            return
+        if self.events == 'none' or (self.events == 'errors' and not error):
+            return
+        self.commands += 1
+        if self.stream:
+            self.client.xadd(self.keys.events, {'event': text},
+                             maxlen=self.stream, approximate=True)
+            return
         self.client.publish(self.keys.external,
                             '{}: {}'.format(self.resource, text))
 
+    def timings(self):
+        """ Return milliseconds waited and held, for the statistics. """
+        now = time.time()
+        begun = now if self.begun is None else self.begun
+        return [int(1000 * (begun - self.drawn)), int(1000 * (now - begun))]
+
+    def crash(self, number):
+        """ Report the crash of a started number and revoke its presence. """
+        self.message('{} crashed!'.format(number), error=True)
+        if self.stats:
+            self.scripts.crash(keys=self.script_keys, args=self.script_args)
+            self.commands += 1
+        self.heartbeat.remove(self.keys.key(number))
+
+    def echo(self, text):
+        """ Pass an event that the scripts leave out to the event sink. """
+        if callable(self.events):
+            self.events(self.resource, text)
+
     def announce(self, number):
-        """ Announce an indicator change on both channels. """
-        self.client.publish(self.keys.internal, self.keys.key(number))
+        """ Announce an indicator change on all channels. """
+        key = self.keys.key(number)
+        self.client.publish(self.keys.internal, key)
+        self.client.publish(self.keys.handoff(number), key)
+        self.commands += 2
         self.message('{} granted'.format(number))
 
+    def leave(self, number, label):
+        """ Leave the queue without having started. """
+        self.heartbeat.discard(self.keys.key(number))
+        args = self.script_args + [number, label, self.slots, 'abandoned']
+        args += self.timings()
+        self.scripts.release(keys=self.script_keys, args=args)
+        self.commands += 1
+        self.echo('{} abandoned by "{}"'.format(number, label))
+
+    def take(self, label, expire):
+        """ Take the resource if nobody is queued, return token or None. """
+        expire = max(expire, 2)
+        token = '{}:{}'.format(uuid.uuid4().hex, label)  # label for status
+        args = self.script_args + [token, expire * 1000]
+        self.commands += 1
+        self.drawn = time.time()
+        if not self.scripts.take(keys=self.script_keys, args=args):
+            return None
+        self.started = True
+        self.heartbeat.track(key=self.keys.fast, expire=expire)
+        return token
+
+    def give(self, token):
+        """ Give back the resource and announce who may start. """
+        self.heartbeat.discard(self.keys.fast)
+        args = self.script_args + [token, self.slots] + self.timings()
+        self.scripts.give(keys=self.script_keys, args=args)
+        self.commands += 1
+
     def bump(self):
         """ Fix indicator in case of unnanounced departments. """
+        args = self.script_args + [self.slots]
+        number = self.scripts.bump(keys=self.script_keys, args=args)
+        self.commands += 1
+        self.measure('bumps', 1)
+        if number is None:
+            number = self.scan()
+        return number
+
+    def scan(self):
+        """ Bump by scanning all numbers, for queues without an index. """
         # read client
         values = self.client.mget(self.keys.indicator, self.keys.dispenser)
+        self.commands += 2  # and the labels below
         indicator, dispenser = map(int, values)
 
         # determine active users
@@ -178,26 +695,310 @@ class Queue(object):
         self.announce(number)
         return number
 
+    def measure(self, name, value):
+        """ Pass a measurement to the metrics hook, if any. """
+        if self.metrics is not None:
+            self.metrics(self.resource, name, value)
+
+    def close(self):
+        if self.subscription is not None:
+            self.subscription.close()
+        self.measure('commands', self.commands)
+
+
+class Group(object):
+    """ Queues for several resources, drawn from and released together. """
+    def __init__(self, client, queues, heartbeat=None,
+                 dispatcher=None, scripts=None, handoff=False):
+        self.client = client
+        self.queues = queues
+        self.heartbeat = heartbeat or Heartbeat(client)
+        self.dispatcher = dispatcher
+        self.scripts = scripts or Scripts(client)
+        self.handoff = handoff
+        self.subscription = None
+
+    def subscribe(self, *channels):
+        """ Return a single subscription to all channels. """
+        if self.dispatcher is None:
+            return Subscription(self.client, *channels)
+        return self.dispatcher.subscribe(*channels)
+
+    @contextlib.contextmanager
+    def draw(self, label, expire):
+        """
+        Return serial numbers for all queues, drawn in a single transaction.
+        """
+        # draw all numbers atomically, so that no other group can get ahead
+        # of us in one queue and behind us in another
+        expire = max(expire, 2)
+        with self.client.pipeline() as pipe:
+            for queue in self.queues:
+                queue.drawn = time.time()
+                args = queue.script_args + [label, expire,
+                                            queue.slots, int(queue.shared)]
+                self.scripts.draw(keys=queue.script_keys,
+                                  args=args, client=pipe)
+                queue.commands += 1
+            results = pipe.execute()
+
+        # keep presences alive
+        numbers = []
+        for queue, (number, started) in zip(self.queues, results):
+            queue.started = bool(started)
+            queue.echo('{} assigned to "{}"'.format(number, label))
+            if queue.started:
+                queue.echo('{} started'.format(number))
+            self.heartbeat.track(key=queue.keys.key(number), expire=expire)
+            numbers.append(number)
+
+        try:
+            yield numbers
+        except BaseException:
+            for queue, number in zip(self.queues, numbers):
+                if queue.started:
+                    queue.crash(number)
+                else:
+                    queue.leave(number=number, label=label)
+            raise
+
+        # revoke presences, advance indicators and announce who may start
+        with self.client.pipeline() as pipe:
+            for queue, number in zip(self.queues, numbers):
+                self.heartbeat.discard(queue.keys.key(number))
+                args = queue.script_args + [number, label, queue.slots,
+                                            'completed'] + queue.timings()
+                self.scripts.release(keys=queue.script_keys,
+                                     args=args, client=pipe)
+                queue.commands += 1
+            pipe.execute()
+        for queue, number in zip(self.queues, numbers):
+            queue.echo('{} completed by "{}"'.format(number, label))
+
+    def wait(self, numbers, patience, timeout=None):
+        """
+        Waits for all numbers and resets if necessary, raises LockTimeout on
+        timeout.
+        """
+        waiting = {queue.keys.key(number): (queue, number)
+                   for queue, number in zip(self.queues, numbers)
+                   if not queue.started}
+        if not waiting:
+            return
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        # subscribe, then see which numbers were announced just before; with
+        # handoff, only the channels for our own numbers are subscribed
+        if self.handoff:
+            channels = [queue.keys.handoff(number)
+                        for queue, number in waiting.values()]
+        else:
+            channels = [queue.keys.internal
+                        for queue, number in waiting.values()]
+        self.subscription = self.subscribe(*channels)
+        with self.client.pipeline(transaction=False) as pipe:
+            for queue, number in waiting.values():
+                args = queue.script_args + [number, queue.slots]
+                self.scripts.check(keys=queue.script_keys,
+                                   args=args, client=pipe)
+                queue.commands += 2  # the subscription and the check
+            results = pipe.execute()
+        for key, started in zip(list(waiting), results):
+            if started:
+                queue, number = waiting.pop(key)
+                queue.started = True
+                queue.message('{} started'.format(number))
+
+        # wait until someone announces each of our numbers
+        while waiting:
+            remaining = patience
+            if deadline is not None:
+                remaining = min(patience, deadline - time.time())
+                if remaining <= 0:
+                    raise LockTimeout(', '.join(
+                        queue.resource for queue, number in waiting.values()
+                    ))
+            message = self.subscription.listen(remaining)
+            if message is None:
+                if remaining < patience:
+                    continue  # deadline passed
+                # timeout beyond patience, bump and try again
+                for queue, number in waiting.values():
+                    queue.message('{} bumps'.format(number), error=True)
+                    queue.bump()
+                continue
+            if message['type'] != 'message':
+                continue  # a subscribe message
+
+            if message['data'] in waiting:
+                queue, number = waiting.pop(message['data'])
+                queue.started = True
+                queue.message('{} started'.format(number))
+
     def close(self):
-        self.subscription.close()
+        if self.subscription is not None:
+            self.subscription.close()
+        for queue in self.queues:
+            queue.close()
+
+
+class Waiter(object):
+    """ A user waiting for its turn within the process. """
+    role = None  # 'hold' on a handover, 'lead' to draw a number
+
+
+class Local(object):
+    """ Users of a resource within this process, sharing a single number. """
+    def __init__(self, resource, cap, locals, guard):
+        self.resource = resource
+        self.cap = cap
+        self.locals = locals  # the locals of the locker, guarded by guard
+        self.guard = guard
+        self.condition = threading.Condition()
+        self.waiters = collections.deque()
+        self.busy = False  # someone in this process draws or holds a number
+        self.stack = None  # releases the number that is currently held
+        self.count = 0  # handovers of the number that is currently held
+        self.gone = False  # removed from the locals of the locker
+
+    def join(self, timeout):
+        """
+        Return 'lead' to draw a number or 'hold' after a handover, or None if
+        this local went idle and is gone from the locals of the locker.
+        """
+        with self.condition:
+            if self.gone:
+                return None
+            if not self.busy:
+                self.busy = True
+                return 'lead'
+            waiter = Waiter()
+            self.waiters.append(waiter)
+            try:
+                self.condition.wait_for(lambda: waiter.role, timeout)
+            except BaseException:
+                self.cancel(waiter)
+                raise
+            if waiter.role is None:
+                self.waiters.remove(waiter)
+                raise LockTimeout(self.resource)
+            return waiter.role
+
+    def cancel(self, waiter):
+        """ Pass on whatever role waiter got before it was interrupted. """
+        with self.condition:
+            if waiter.role is None:
+                self.waiters.remove(waiter)
+            elif waiter.role == 'lead':
+                self.promote()
+            else:
+                stack = self.leave()
+                if stack is not None:
+                    stack.close()
+
+    def start(self, stack):
+        """ Start holding a number, released by closing the stack. """
+        with self.condition:
+            self.stack = stack
+            self.count = 0
+
+    def promote(self):
+        """ Let the first waiter draw a new number, if any, or go. """
+        with self.condition:
+            if self.waiters:
+                self.waiters.popleft().role = 'lead'
+                self.condition.notify_all()
+            else:
+                self.busy = False
+                self.gone = True
+                with self.guard:
+                    if self.locals.get(self.resource) is self:
+                        del self.locals[self.resource]
+
+    def leave(self):
+        """
+        Hand over to the first waiter, or return the stack that releases the
+        number if the cap is reached, so that other processes get their turn.
+        """
+        with self.condition:
+            if self.waiters and self.count < self.cap:
+                self.count += 1
+                self.waiters.popleft().role = 'hold'
+                self.condition.notify_all()
+                return None
+            stack, self.stack = self.stack, None
+            self.promote()
+            return stack
 
 
 class Locker(object):
     """ Wraps a redis client. """
-    cache = {}
+    cache = {}  # key => client
+    shared = {}  # key => heartbeat and dispatcher shared by lockers
 
-    def __init__(self, **kwargs):
-        """ The args and kwargs are passed to Redis instance. """
-        enc = str(sorted(kwargs.items())).encode('utf-8')
-        key = hashlib.md5(enc).hexdigest()
+    def __init__(self, handoff=False, coalesce=0, reentrant=False,
+                 stream=0, events='all', idle=0, metrics=None, stats=0,
+                 client=None, **kwargs):
+        """
+        The kwargs are passed to Redis instance.
 
-        if key not in self.cache:
-            self.cache[key] = redis.Redis(decode_responses=True, **kwargs)
+        :param handoff: Wake only the user whose number is announced
+        :param coalesce: Hand a lock over to at most this many threads of
+            this process in a row, before releasing it
+        :param reentrant: Let a thread lock resources it already holds
+        :param stream: Write events to a stream per resource, keeping about
+            this many, instead of publishing them
+        :param events: 'all', 'errors' or 'none' to select the events to
+            emit, 'batched' to emit all events in batches from a thread, or
+            a callable receiving the resource and the text of each event
+        :param idle: Let the keys of a queue expire after it has been idle
+            for this many seconds
+        :param metrics: Callable receiving the resource, the name and the
+            value of each measurement of wait time, hold time, bumps and
+            round trips per lock
+        :param stats: Keep statistics per resource and minute in redis for
+            this many seconds
+        :param client: Redis or RedisCluster client to use instead, which
+            must decode responses
+        """
+        if client is None:
+            enc = str(sorted(kwargs.items())).encode('utf-8')
+            key = hashlib.md5(enc).hexdigest()
+            if key not in self.cache:
+                self.cache[key] = redis.Redis(decode_responses=True, **kwargs)
+                self.shared[key] = (Heartbeat(self.cache[key]),
+                                    Dispatcher(self.cache[key]))
+            client = self.cache[key]
+            self.heartbeat, self.dispatcher = self.shared[key]
+            self.owner = False  # of the heartbeat and dispatcher
+        else:
+            self.heartbeat = Heartbeat(client)
+            self.dispatcher = Dispatcher(client)
+            self.owner = True
 
-        self.client = self.cache[key]
+        self.client = client
+        self.scripts = Scripts(self.client)
+        self.handoff = handoff
+        self.coalesce = coalesce
+        self.locals = {}  # resource => local users
+        self.guard = threading.Lock()
+        self.reentrant = reentrant
+        self.held = {}  # (thread, resource) => depth
+        self.stream = stream
+        if events == 'batched':
+            events = Batcher(client=self.client, stream=stream)
+        elif not callable(events) and events not in ('all', 'errors', 'none'):
+            raise ValueError('Unknown events "{}".'.format(events))
+        self.events = events
+        self.idle = idle
+        self.metrics = metrics
+        self.stats = stats
 
     @contextlib.contextmanager
-    def lock(self, resource, label='', expire=60, patience=60):
+    def lock(self, resource, label='', expire=60, patience=60,
+             slots=1, shared=False, timeout=None, blocking=True,
+             mode='queue'):
         """
         Lock a resource.
 
@@ -205,9 +1006,290 @@ class Locker(object):
         :param label: String label to attach
         :param expire: int seconds
         :param patience: int seconds
+        :param slots: int number of users allowed at the same time
+        :param shared: Allow other shared users at the same time
+        :param timeout: Seconds after which to give up with LockTimeout
+        :param blocking: Give up right away if the resource is taken
+        :param mode: 'fast' to take an idle resource without queueing
+        """
+        since = time.time()
+        timeout = get_timeout(timeout=timeout, blocking=blocking)
+        fast = get_fast(mode=mode, slots=slots, shared=shared)
+        if self.reentrant and self.holds(resource):
+            # nested in a lock on the same resource by the same thread
+            with self.holding([resource], since=since):
+                yield
+            return
+
+        if self.coalesce and not fast and slots == 1 and not shared:
+            with self.coalesced(resource=resource,
+                                label=label,
+                                expire=expire,
+                                patience=patience,
+                                timeout=timeout):
+                with self.holding([resource], since=since):
+                    yield
+            return
+
+        queue = Queue(client=self.client,
+                      resource=resource,
+                      slots=slots,
+                      shared=shared,
+                      heartbeat=self.heartbeat,
+                      dispatcher=self.dispatcher,
+                      scripts=self.scripts,
+                      handoff=self.handoff,
+                      stream=self.stream,
+                      events=self.events,
+                      idle=self.idle,
+                      metrics=self.metrics,
+                      stats=self.stats)
+        token = queue.take(label=label, expire=expire) if fast else None
+        if token is not None:
+            try:
+                with self.holding([resource], since=since):
+                    yield
+            finally:
+                queue.give(token)
+                queue.close()
+            return
+
+        try:
+            with queue.draw(label=label, expire=expire) as number:
+                queue.wait(number=number, patience=patience,
+                           timeout=timeout)
+                with self.holding([resource], since=since):
+                    yield
+        finally:
+            queue.close()
+
+    def holds(self, resource):
+        """ Return whether the current thread holds a lock on resource. """
+        return (threading.get_ident(), resource) in self.held
+
+    @contextlib.contextmanager
+    def holding(self, resources, since):
         """
-        queue = Queue(client=self.client, resource=resource)
-        with queue.draw(label=label, expire=expire) as number:
-            queue.wait(number=number, patience=patience)
+        Count resources as held by the current thread, measuring the time
+        waited since given time and the time held.
+        """
+        start = time.time()
+        for resource in resources:
+            self.measure(resource, 'wait', start - since)
+        ident = threading.get_ident()
+        keys = [(ident, resource) for resource in resources]
+        for key in keys:
+            self.held[key] = self.held.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            for key in keys:
+                self.held[key] -= 1
+                if not self.held[key]:
+                    del self.held[key]
+            for resource in resources:
+                self.measure(resource, 'hold', time.time() - start)
+
+    def measure(self, resource, name, value):
+        """ Pass a measurement to the metrics hook, if any. """
+        if self.metrics is not None:
+            self.metrics(resource, name, value)
+
+    @contextlib.contextmanager
+    def coalesced(self, resource, label, expire, patience, timeout):
+        """ Lock a resource, sharing a number with other local users. """
+        deadline = None if timeout is None else time.time() + timeout
+        role = None
+        while role is None:
+            with self.guard:
+                if resource not in self.locals:
+                    self.locals[resource] = Local(resource=resource,
+                                                  cap=self.coalesce,
+                                                  locals=self.locals,
+                                                  guard=self.guard)
+                local = self.locals[resource]
+            role = local.join(timeout=timeout)
+
+        if role == 'lead':
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            queue = Queue(client=self.client,
+                          resource=resource,
+                          heartbeat=self.heartbeat,
+                          dispatcher=self.dispatcher,
+                          scripts=self.scripts,
+                          handoff=self.handoff,
+                          stream=self.stream,
+                          events=self.events,
+                          idle=self.idle,
+                          metrics=self.metrics,
+                          stats=self.stats)
+            stack = contextlib.ExitStack()
+            try:
+                stack.callback(queue.close)
+                number = stack.enter_context(
+                    queue.draw(label=label, expire=expire),
+                )
+                queue.wait(number=number, patience=patience,
+                           timeout=timeout)
+            except BaseException:
+                local.promote()
+                stack.__exit__(*sys.exc_info())
+                raise
+            local.start(stack)
+
+        try:
             yield
-        queue.close()
+        finally:
+            stack = local.leave()
+            if stack is not None:
+                stack.close()
+
+    @contextlib.contextmanager
+    def lock_many(self, resources, label='', expire=60, patience=60,
+                  slots=1, shared=False, timeout=None, blocking=True):
+        """
+        Lock several resources at once, releasing them together.
+
+        Numbers are drawn for all resources in a single transaction, in
+        sorted order, so that users of lock_many cannot deadlock each other.
+        On a Redis Cluster, the resources are locked one by one instead, in
+        the same order.
+
+        :param resources: Strings corresponding to resource types
+        :param label: String label to attach
+        :param expire: int seconds
+        :param patience: int seconds
+        :param slots: int number of users allowed at the same time
+        :param shared: Allow other shared users at the same time
+        :param timeout: Seconds after which to give up with LockTimeout
+        :param blocking: Give up right away if a resource is taken
+        """
+        since = time.time()
+        timeout = get_timeout(timeout=timeout, blocking=blocking)
+        resources = sorted(set(resources))
+        if is_cluster(self.client):
+            # a transaction cannot span the slots of several resources
+            deadline = None if timeout is None else time.time() + timeout
+            with contextlib.ExitStack() as stack:
+                for resource in resources:
+                    if deadline is not None:
+                        timeout = max(0, deadline - time.time())
+                    # the resources are final, even for a subclass
+                    stack.enter_context(Locker.lock(
+                        self, resource=resource, label=label, expire=expire,
+                        patience=patience, slots=slots, shared=shared,
+                        timeout=timeout,
+                    ))
+                yield
+            return
+
+        queues = [Queue(client=self.client,
+                        resource=resource,
+                        slots=slots,
+                        shared=shared,
+                        heartbeat=self.heartbeat,
+                        dispatcher=self.dispatcher,
+                        scripts=self.scripts,
+                        handoff=self.handoff,
+                        stream=self.stream,
+                        events=self.events,
+                        idle=self.idle,
+                        metrics=self.metrics,
+                        stats=self.stats)
+                  for resource in resources
+                  if not (self.reentrant and self.holds(resource))]
+        group = Group(client=self.client,
+                      queues=queues,
+                      heartbeat=self.heartbeat,
+                      dispatcher=self.dispatcher,
+                      scripts=self.scripts,
+                      handoff=self.handoff)
+        try:
+            with group.draw(label=label, expire=expire) as numbers:
+                group.wait(numbers=numbers, patience=patience,
+                           timeout=timeout)
+                with self.holding(resources, since=since):
+                    yield
+        finally:
+            group.close()
+
+    def close(self):
+        """
+        Stop background threads and close the pubsub connection. Lockers
+        without a client of their own share these and leave them running.
+        """
+        if isinstance(self.events, Batcher):
+            self.events.close()
+        if self.owner:
+            self.heartbeat.close()
+            self.dispatcher.close()
+
+
+class StripedLocker(Locker):
+    """
+    Locks resources on a fixed number of stripes, so that the number of keys
+    and channels in redis stays bounded, however many resources there are.
+    """
+    def __init__(self, stripes=1024, name='stripe', **kwargs):
+        """
+        The kwargs are passed to the locker.
+
+        :param stripes: Number of stripes to hash the resources onto
+        :param name: Name of the stripes, to stripe resources separately
+        """
+        super(StripedLocker, self).__init__(**kwargs)
+        self.stripes = stripes
+        self.name = name
+        self.claims = {}  # stripe => counter of resources claiming it
+        self.claimed = 0
+        self.collided = 0
+
+    def stripe(self, resource):
+        """ Return the stripe of a resource. """
+        digest = hashlib.md5(resource.encode('utf-8')).hexdigest()
+        return '{}:{}'.format(self.name, int(digest, 16) % self.stripes)
+
+    @contextlib.contextmanager
+    def claiming(self, resources):
+        """
+        Return stripes for resources, counting the claims on them that
+        collide with claims of other resources by this locker.
+        """
+        stripes = [self.stripe(resource) for resource in resources]
+        with self.guard:
+            for stripe, resource in zip(stripes, resources):
+                claims = self.claims.setdefault(stripe, collections.Counter())
+                self.claimed += 1
+                if any(r != resource for r in claims):
+                    self.collided += 1
+                claims[resource] += 1
+        try:
+            yield stripes
+        finally:
+            with self.guard:
+                for stripe, resource in zip(stripes, resources):
+                    claims = self.claims[stripe]
+                    claims[resource] -= 1
+                    if not claims[resource]:
+                        del claims[resource]
+                    if not claims:
+                        del self.claims[stripe]
+
+    def collision_rate(self):
+        """ Return the fraction of claims that collided so far. """
+        return self.collided / self.claimed if self.claimed else 0.0
+
+    @contextlib.contextmanager
+    def lock(self, resource, **kwargs):
+        """ Lock the stripe of a resource, see Locker.lock. """
+        with self.claiming([resource]) as stripes:
+            with super(StripedLocker, self).lock(stripes[0], **kwargs):
+                yield
+
+    @contextlib.contextmanager
+    def lock_many(self, resources, **kwargs):
+        """ Lock the stripes of several resources, see Locker.lock_many. """
+        with self.claiming(sorted(set(resources))) as stripes:
+            with super(StripedLocker, self).lock_many(stripes, **kwargs):
+                yield
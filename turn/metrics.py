@@ -0,0 +1,129 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+A collector for the measurements of lockers, to pass as their metrics hook.
+It keeps histograms of wait and hold times and counters of bumps and round
+trips per resource, and exposes them in the Prometheus text format, or to
+the registry of the prometheus_client package.
+"""
+
+import bisect
+import collections
+import threading
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+HISTOGRAMS = {
+    'wait': 'Seconds waited for a lock.',
+    'hold': 'Seconds a lock was held.',
+}
+COUNTERS = {
+    'bumps': 'Bumps of a queue.',
+    'commands': 'Round trips to redis for locks.',
+}
+
+
+class Histogram(object):
+    """ Counts of values per bucket, with their sum. """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        """ Return (upper bound, count) pairs, ending with infinity. """
+        bounds = [str(b) for b in self.buckets] + ['+Inf']
+        counts, total = [], 0
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return list(zip(bounds, counts))
+
+
+class Collector(object):
+    """ Collects measurements per resource, Prometheus style. """
+    def __init__(self, buckets=BUCKETS, prefix='turn'):
+        """
+        :param buckets: Upper bounds of the buckets of the histograms
+        :param prefix: Prefix for the names of the metrics
+        """
+        self.buckets = sorted(buckets)
+        self.prefix = prefix
+        self.histograms = {}  # (name, resource) => histogram
+        self.counters = collections.Counter()  # (name, resource) => total
+        self.lock = threading.Lock()
+
+    def __call__(self, resource, name, value):
+        """ Record a measurement, as received from a locker. """
+        with self.lock:
+            if name in HISTOGRAMS:
+                key = name, resource
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.buckets)
+                self.histograms[key].observe(value)
+            else:
+                self.counters[name, resource] += value
+
+    def samples(self):
+        """
+        Return (metric, type, help, samples) tuples, with samples as
+        (suffix, labels, value) tuples.
+        """
+        metrics = []
+        with self.lock:
+            for name, text in sorted(HISTOGRAMS.items()):
+                samples = []
+                for (n, resource), histogram in sorted(
+                        self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        labels = {'resource': resource, 'le': bound}
+                        samples.append(('_bucket', labels, count))
+                    labels = {'resource': resource}
+                    samples.append(('_sum', labels, histogram.sum))
+                    samples.append(('_count', labels, sum(histogram.counts)))
+                metric = '{}_{}_seconds'.format(self.prefix, name)
+                metrics.append((metric, 'histogram', text, samples))
+            for name, text in sorted(COUNTERS.items()):
+                samples = [('_total', {'resource': resource}, value)
+                           for (n, resource), value
+                           in sorted(self.counters.items()) if n == name]
+                metric = '{}_{}'.format(self.prefix, name)
+                metrics.append((metric, 'counter', text, samples))
+        return metrics
+
+    def expose(self):
+        """ Return the metrics in the Prometheus text exposition format. """
+        lines = []
+        for metric, kind, text, samples in self.samples():
+            lines.append('# HELP {} {}'.format(metric, text))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for suffix, labels, value in samples:
+                pairs = ','.join('{}="{}"'.format(k, escape(v))
+                                 for k, v in sorted(labels.items()))
+                lines.append('{}{}{{{}}} {}'.format(
+                    metric, suffix, pairs, value,
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def collect(self):
+        """
+        Yield metric families, so that the collector can be registered with
+        the prometheus_client package, which is imported only here.
+        """
+        from prometheus_client.core import Metric
+
+        for metric, kind, text, samples in self.samples():
+            family = Metric(metric, text, kind)
+            for suffix, labels, value in samples:
+                family.add_sample(metric + suffix, labels, value)
+            yield family
+
+
+def escape(value):
+    """ Return label value escaped for the text exposition format. """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
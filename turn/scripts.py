@@ -0,0 +1,363 @@
+# (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
+# -*- coding: utf-8 -*-
+"""
+Lua scripts performing steps of the queue protocol server-side, each step in
+a single atomic round trip. All scripts take the dispenser, the indicator, the
+index of drawn numbers, the index of exclusive numbers, the key for users in
+fast mode, the registry of resources (or the dispenser again, if resources
+are not registered) and the event stream as keys and start
+their arguments with the resource, the internal channel, the external
+channel, the prefix for the serial number keys, the prefix for the handoff
+channels, the maximum length of the event stream, zero for publishing
+events on the external channel instead, whether to emit events at all, the
+number of seconds after which the keys of an idle queue expire, zero for
+keeping them, the prefix for the statistics per minute and the number of
+seconds to keep those, zero for keeping no statistics.
+"""
+
+PRELUDE = """
+local dispenser, indicator = KEYS[1], KEYS[2]
+local index, exclusive, fast = KEYS[3], KEYS[4], KEYS[5]
+local registry, events = KEYS[6], KEYS[7]
+local resource, internal, external = ARGV[1], ARGV[2], ARGV[3]
+local serial, handoff, maxlen = ARGV[4], ARGV[5], tonumber(ARGV[6])
+local verbose, idle = ARGV[7] == '1', tonumber(ARGV[8])
+local stats, keep = ARGV[9], tonumber(ARGV[10])
+
+local function message(text)
+    if not verbose then
+        return
+    end
+    if maxlen > 0 then
+        redis.call('XADD', events, 'MAXLEN', '~', maxlen, '*', 'event', text)
+    else
+        redis.call('PUBLISH', external, resource .. ': ' .. text)
+    end
+end
+
+local function bucket(ms)
+    -- return the exponent of the power of two milliseconds bounding ms
+    local exponent = 0
+    while 2 ^ exponent < ms do
+        exponent = exponent + 1
+    end
+    return exponent
+end
+
+local function record(counts, times)
+    -- add counts and times in milliseconds to the statistics of the minute
+    if keep == 0 then
+        return
+    end
+    local key = stats .. math.floor(redis.call('TIME')[1] / 60)
+    for field, count in pairs(counts) do
+        redis.call('HINCRBY', key, field, count)
+    end
+    for name, ms in pairs(times) do
+        ms = math.floor(ms)
+        redis.call('HINCRBY', key, name .. ':sum', ms)
+        redis.call('HINCRBY', key, name .. ':' .. bucket(ms), 1)
+    end
+    redis.call('EXPIRE', key, keep)
+end
+
+local function settle()
+    -- let the keys of a queue expire while nobody uses it, keep them while
+    -- anybody does
+    local keys = {dispenser, indicator, index, exclusive, events}
+    if redis.call('EXISTS', index, fast) == 0 then
+        if idle > 0 then
+            for _, key in ipairs(keys) do
+                redis.call('EXPIRE', key, idle)
+            end
+        end
+    elseif redis.call('TTL', dispenser) >= 0 then
+        for _, key in ipairs(keys) do
+            redis.call('PERSIST', key)
+        end
+    end
+end
+
+local function announce(number)
+    redis.call('PUBLISH', internal, serial .. number)
+    redis.call('PUBLISH', handoff .. number, serial .. number)
+    message(number .. ' granted')
+end
+
+local function window(slots)
+    -- return the first present numbers, dropping absent ones from the index
+    local numbers = {}
+    local start = 0
+    while #numbers < slots do
+        local stop = start + slots - #numbers - 1
+        local batch = redis.call('ZRANGE', index, start, stop)
+        if #batch == 0 then
+            break
+        end
+        for _, number in ipairs(batch) do
+            if redis.call('EXISTS', serial .. number) == 1 then
+                table.insert(numbers, tonumber(number))
+                start = start + 1
+            else
+                redis.call('ZREM', index, number)
+                redis.call('ZREM', exclusive, number)
+            end
+        end
+    end
+    return numbers
+end
+
+local function barrier()
+    -- return the first present exclusive number, dropping absent ones
+    while true do
+        local number = redis.call('ZRANGE', exclusive, 0, 0)[1]
+        if number == nil then
+            return nil
+        end
+        if redis.call('EXISTS', serial .. number) == 1 then
+            return tonumber(number)
+        end
+        redis.call('ZREM', index, number)
+        redis.call('ZREM', exclusive, number)
+    end
+end
+
+local function shared(after)
+    -- return numbers after given number up to the barrier, all shared
+    local stop = barrier()
+    stop = stop and '(' .. stop or '+inf'
+    return redis.call('ZRANGEBYSCORE', index, '(' .. after, stop)
+end
+
+local function admitted(number, slots)
+    -- numbers among the first in the index may start, and so may shared
+    -- numbers with only shared numbers ahead of them, unless the resource
+    -- is taken in fast mode
+    if redis.call('EXISTS', fast) == 1 then
+        return false
+    end
+    local rank = redis.call('ZRANK', index, number)
+    if not rank then
+        return false
+    end
+    if rank < slots then
+        return true
+    end
+    if redis.call('ZSCORE', exclusive, number) then
+        return false
+    end
+    local first = redis.call('ZRANGE', exclusive, 0, 0)[1]
+    return not first or tonumber(first) > number
+end
+
+local function admit(numbers)
+    -- announce the given numbers and the shared numbers following them
+    local announced = {}
+    for _, number in ipairs(numbers) do
+        announce(number)
+        announced[number] = true
+    end
+    for _, number in ipairs(shared(numbers[1])) do
+        number = tonumber(number)
+        if not announced[number] then
+            announce(number)
+        end
+    end
+end
+"""
+
+# draw a number, signal presence and start right away if there is room
+DRAW = """
+local label, expire, slots = ARGV[11], ARGV[12], tonumber(ARGV[13])
+local share = ARGV[14] == '1'
+
+redis.call('MSETNX', dispenser, 0, indicator, 1)
+if registry ~= dispenser then
+    redis.call('SADD', registry, resource)
+end
+local number = redis.call('INCR', dispenser)
+message(number .. ' assigned to "' .. label .. '"')
+redis.call('SET', serial .. number, label, 'EX', expire)
+redis.call('ZADD', index, number, number)
+if not share then
+    redis.call('ZADD', exclusive, number, number)
+end
+settle()
+
+if admitted(number, slots) then
+    message(number .. ' started')
+    return {number, 1}
+end
+return {number, 0}
+"""
+
+# revoke presence, point the indicator at the first number that is still
+# present and announce numbers that may start now, or the next one to be
+# drawn if no one is left. Numbers that never started leave the same way.
+RELEASE = """
+local number, label, slots = tonumber(ARGV[11]), ARGV[12], tonumber(ARGV[13])
+local verb, wait, hold = ARGV[14], tonumber(ARGV[15]), tonumber(ARGV[16])
+local last = tonumber(redis.call('ZRANGE', index, slots - 1, slots - 1)[1])
+local first = tonumber(redis.call('ZRANGE', exclusive, 0, 0)[1])
+
+redis.call('DEL', serial .. number)
+redis.call('ZREM', index, number)
+redis.call('ZREM', exclusive, number)
+message(number .. ' ' .. verb .. ' by "' .. label .. '"')
+if verb == 'completed' then
+    record({completed = 1}, {wait = wait, hold = hold})
+else
+    record({[verb] = 1}, {wait = wait})
+end
+
+local numbers = window(slots)
+redis.call('SET', indicator, numbers[1] or number + 1)
+settle()
+if redis.call('EXISTS', fast) == 1 then
+    return  -- announced when the resource is given back
+end
+if #numbers == 0 then
+    announce(number + 1)
+    return
+end
+
+-- numbers entering the window
+local announced = {}
+for _, following in ipairs(numbers) do
+    if last and following > last then
+        announce(following)
+        announced[following] = true
+    end
+end
+
+-- shared numbers that were waiting for an exclusive number
+if first then
+    for _, following in ipairs(shared(first - 1)) do
+        following = tonumber(following)
+        if not announced[following] then
+            announce(following)
+        end
+    end
+end
+"""
+
+# point the indicator at the first number that is still present and
+# announce all numbers that may start
+BUMP = """
+local slots = tonumber(ARGV[11])
+
+if redis.call('EXISTS', index) == 0 then
+    return nil  -- not indexed, only older clients use this queue
+end
+
+record({bumps = 1}, {})
+local numbers = window(slots)
+local number = numbers[1] or tonumber(redis.call('GET', dispenser)) + 1
+if number ~= tonumber(redis.call('GET', indicator)) then
+    redis.call('SET', indicator, number)
+end
+settle()
+if redis.call('EXISTS', fast) == 1 then
+    return number  -- announced when the resource is given back
+end
+if #numbers == 0 then
+    announce(number)
+else
+    admit(numbers)
+end
+return number
+"""
+
+# whether a number may start
+CHECK = """
+local number, slots = tonumber(ARGV[11]), tonumber(ARGV[12])
+
+if admitted(number, slots) then
+    return 1
+end
+return 0
+"""
+
+
+# take the resource in fast mode, if nobody is queued for it
+TAKE = """
+local token, expire = ARGV[11], ARGV[12]
+
+redis.call('MSETNX', dispenser, 0, indicator, 1)
+if registry ~= dispenser then
+    redis.call('SADD', registry, resource)
+end
+if redis.call('EXISTS', index) == 1 then
+    return 0
+end
+if redis.call('SET', fast, token, 'NX', 'PX', expire) then
+    settle()
+    return 1
+end
+return 0
+"""
+
+# give back the resource taken in fast mode, if it is still ours, and
+# announce all numbers that may start
+GIVE = """
+local token, slots = ARGV[11], tonumber(ARGV[12])
+local wait, hold = tonumber(ARGV[13]), tonumber(ARGV[14])
+
+if redis.call('GET', fast) ~= token then
+    return 0
+end
+redis.call('DEL', fast)
+settle()
+record({completed = 1}, {wait = wait, hold = hold})
+local numbers = window(slots)
+if #numbers > 0 then
+    admit(numbers)
+end
+return 1
+"""
+
+# remove the keys of a queue that nobody uses, and the resource from the
+# registry, or only the keys that outlived the dispenser, such as the stream
+COLLECT = """
+if redis.call('EXISTS', dispenser) == 0 then
+    redis.call('DEL', indicator, index, exclusive, events)
+    if redis.call('PTTL', fast) == -1 then
+        redis.call('DEL', fast)  -- without expiry, nobody holds it
+    end
+else
+    if redis.call('EXISTS', fast) == 1 then
+        return 0
+    end
+    local indexed = redis.call('EXISTS', index) == 1
+    if indexed and #window(1) > 0 then
+        return 0
+    end
+    local number = tonumber(redis.call('GET', dispenser))
+    if not indexed and tonumber(redis.call('GET', indicator)) <= number then
+        return 0  -- not indexed, only older clients use this queue
+    end
+    redis.call('DEL', dispenser, indicator, index, exclusive, events)
+end
+if registry ~= dispenser then
+    redis.call('SREM', registry, resource)
+end
+return 1
+"""
+
+# count a crash of a user
+CRASH = """
+record({crashed = 1}, {})
+"""
+
+
+class Scripts(object):
+    """ Scripts registered with a client, executed by their SHA1 digest. """
+    def __init__(self, client):
+        self.draw = client.register_script(PRELUDE + DRAW)
+        self.release = client.register_script(PRELUDE + RELEASE)
+        self.bump = client.register_script(PRELUDE + BUMP)
+        self.check = client.register_script(PRELUDE + CHECK)
+        self.take = client.register_script(PRELUDE + TAKE)
+        self.give = client.register_script(PRELUDE + GIVE)
+        self.collect = client.register_script(PRELUDE + COLLECT)
+        self.crash = client.register_script(PRELUDE + CRASH)
@@ -1,7 +1,9 @@
 # (c) Nelen & Schuurmans.  GPL licensed, see LICENSE.rst.
 # -*- coding: utf-8 -*-
 
+import asyncio
 import io
+import json
 import os
 import random
 import signal
@@ -9,10 +11,16 @@ import sys
 import threading
 import time
 import unittest
+from unittest import mock
 
+import redis
+
+from turn import aio
+from turn import benchmark
 from turn import console
 from turn import tools
 from turn import core
+from turn import metrics
 
 HOST = 'redis'
 
@@ -86,17 +94,548 @@ class TestCore(TestBase):
         message = 'test_message'
         client.publish(channel, 'test_message')
         self.assertEqual(subscription.listen()['data'], message)
+        subscription.close()
+
+    def test_dispatcher(self):
+        client = self.locker.client
+        channel = 'test_channel'
+        dispatcher = core.Dispatcher(client)
+        listener1 = dispatcher.subscribe(channel)
+        listener2 = dispatcher.subscribe(channel)
+        self.assertEqual(client.pubsub_numsub(channel), [(channel, 1)])
+
+        # no message
+        self.assertIsNone(listener1.listen(timeout=0.01))
+
+        # message for both
+        message = 'test_message'
+        client.publish(channel, message)
+        self.assertEqual(listener1.listen()['data'], message)
+        self.assertEqual(listener2.listen()['data'], message)
+
+        # unsubscribe after the last listener leaves
+        listener1.close()
+        self.assertEqual(client.pubsub_numsub(channel), [(channel, 1)])
+        listener2.close()
+        time.sleep(0.01)
+        self.assertEqual(client.pubsub_numsub(channel), [(channel, 0)])
+        self.assertFalse(dispatcher.pending)
+
+    def test_dispatcher_reconnect(self):
+        client = self.locker.client
+        channel = 'test_channel'
+        dispatcher = core.Dispatcher(client)
+        listener = dispatcher.subscribe(channel)
+        get_message = dispatcher.pubsub.get_message
+        failed = threading.Event()
+
+        def fail(timeout):
+            dispatcher.pubsub.get_message = get_message
+            dispatcher.pubsub.connection.disconnect()
+            failed.set()
+            raise redis.ConnectionError()
+
+        # messages arrive again once the pubsub has resubscribed
+        with self.assertLogs('turn.core', level='ERROR'):
+            dispatcher.pubsub.get_message = fail
+            failed.wait()
+            message = None
+            while message is None:
+                client.publish(channel, 'test_message')
+                message = listener.listen(timeout=0.1)
+        self.assertEqual(message['data'], 'test_message')
+        listener.close()
+
+    def test_dispatcher_timeout(self):
+        dispatcher = core.Dispatcher(self.locker.client)
+        dispatcher.timeout = 0.1
+        # acknowledgements never arrive
+        dispatcher.pubsub.get_message = lambda timeout: time.sleep(timeout)
+        with self.assertRaises(redis.TimeoutError):
+            dispatcher.subscribe('test_channel')
+        self.assertFalse(dispatcher.listeners)
+        self.assertFalse(dispatcher.pending)
 
-    def test_keeper(self):
+    def test_locker_shared(self):
+        # lockers of the same server share their threads and connections
         client = self.locker.client
+        threads = threading.active_count()
+        connections = len(client.client_list())
+        for _ in range(50):
+            with core.Locker(host=HOST, db=0).lock(**self.kwargs):
+                pass
+        self.assertLessEqual(threading.active_count() - threads, 2)
+        self.assertLessEqual(len(client.client_list()) - connections, 3)
+
+    def test_locker_close(self):
+        client = redis.Redis(host=HOST, decode_responses=True)
+        locker = core.Locker(client=client, events='batched')
+        with locker.lock(**self.kwargs):
+            pass
+        threads = [locker.heartbeat.thread,
+                   locker.dispatcher.thread,
+                   locker.events.thread]
+        locker.close()
+        for thread in threads:
+            self.assertFalse(thread is not None and thread.is_alive())
+        self.assertIsNone(locker.dispatcher.pubsub.connection)
+
+    def test_heartbeat(self):
+        client = self.locker.client
+        heartbeat = core.Heartbeat(client)
         key = 'test_key'
         label = 'test_label'
-        keeper = core.Keeper(client=client, key=key, label=label, expire=60)
-        time.sleep(0.01)
+        heartbeat.add(key=key, label=label, expire=2)
         self.assertEqual(client.get(key), label)
-        keeper.close()
+        time.sleep(1.1)
+        self.assertGreater(client.pttl(key), 1000)  # renewed
+        heartbeat.remove(key)
         self.assertIsNone(client.get(key))
 
+    def test_heartbeat_retry(self):
+        client = redis.Redis(host=HOST, decode_responses=True)
+        heartbeat = core.Heartbeat(client)
+        key = 'test_key'
+        pipeline = client.pipeline
+
+        def fail(**kwargs):
+            client.pipeline = pipeline
+            raise redis.ConnectionError()
+
+        # a failed renewal is retried before the key expires
+        with self.assertLogs('turn.core', level='ERROR'):
+            client.pipeline = fail
+            heartbeat.add(key=key, label=self.label, expire=3)
+            time.sleep(3)
+        self.assertGreater(client.pttl(key), 2000)
+        heartbeat.remove(key)
+
+    def test_heartbeat_compact(self):
+        heartbeat = core.Heartbeat(self.locker.client)
+        keys = ['test_key_{}'.format(n) for n in range(100)]
+        for key in keys:
+            heartbeat.add(key=key, label=self.label, expire=60)
+        for key in keys:
+            heartbeat.remove(key)
+        self.assertLess(len(heartbeat.heap), 100)
+        self.assertFalse(heartbeat.keys)
+
+    def test_bump(self):
+        client = self.locker.client
+        queue = core.Queue(client=client, resource=self.resource)
+        with queue.draw(label=self.label, expire=60) as number1:
+            with queue.draw(label=self.label, expire=60) as number2:
+                with queue.draw(label=self.label, expire=60) as number3:
+                    # presence of the first two numbers expires
+                    client.delete(queue.keys.key(number1))
+                    client.delete(queue.keys.key(number2))
+                    self.assertEqual(queue.bump(), number3)
+                    self.assertEqual(client.zcard(queue.keys.index), 1)
+        self.assertEqual(queue.bump(), number3 + 1)
+        queue.close()
+
+    def test_bump_without_index(self):
+        # a queue as left behind by clients that do not index numbers
+        client = self.locker.client
+        queue = core.Queue(client=client, resource=self.resource)
+        with queue.draw(label=self.label, expire=60) as number1:
+            with queue.draw(label=self.label, expire=60) as number2:
+                client.delete(queue.keys.index, queue.keys.key(number1))
+                self.assertEqual(queue.bump(), number2)
+        queue.close()
+
+    def test_handoff(self):
+        locker = core.Locker(host=HOST, handoff=True)
+        keys = core.Keys(self.resource)
+
+        def lock():
+            with locker.lock(**self.kwargs):
+                pass
+
+        with locker.lock(**self.kwargs):
+            thread = threading.Thread(target=lock)
+            thread.start()
+            time.sleep(0.01)
+            # the waiting user only listens to the channel for its number
+            number = int(locker.client.get(keys.dispenser))
+            channels = [keys.internal, keys.handoff(number)]
+            numsub = locker.client.pubsub_numsub(*channels)
+            self.assertEqual(numsub, [(channels[0], 0), (channels[1], 1)])
+        thread.join()
+        self.assertFalse(locker.dispatcher.pending)
+
+    def test_slots(self):
+        guard = threading.Lock()
+        active = []
+        peaks = []
+
+        def lock(sleep):
+            kwargs = dict(self.kwargs, patience=60)
+            with self.locker.lock(slots=2, **kwargs):
+                with guard:
+                    active.append(sleep)
+                    peaks.append(len(active))
+                time.sleep(sleep)
+                with guard:
+                    active.remove(sleep)
+
+        # the short ones release out of order
+        sleeps = [0.05, 0.01, 0.01, 0.01, 0.01]
+        threads = [threading.Thread(target=lock, args=(sleep,))
+                   for sleep in sleeps]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(peaks), 2)
+        self.assertEqual(len(peaks), len(sleeps))
+
+    def test_shared(self):
+        guard = threading.Lock()
+        active = set()
+        overlaps = {}
+
+        def lock(name, shared):
+            kwargs = dict(self.kwargs, patience=60)
+            with self.locker.lock(shared=shared, **kwargs):
+                with guard:
+                    active.add(name)
+                    overlaps[name] = set(active)
+                    for other in active:
+                        overlaps[other].add(name)
+                time.sleep(0.02)
+                with guard:
+                    active.remove(name)
+
+        # start users one by one, in order of drawing
+        client = self.locker.client
+        dispenser = core.Keys(self.resource).dispenser
+        users = [('r1', True), ('r2', True), ('w', False),
+                 ('r3', True), ('r4', True)]
+        threads = [threading.Thread(target=lock, args=user) for user in users]
+        for thread in threads:
+            number = int(client.get(dispenser) or 0)
+            thread.start()
+            while int(client.get(dispenser) or 0) == number:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps['w'], {'w'})
+        self.assertEqual(overlaps['r1'], {'r1', 'r2'})
+        self.assertEqual(overlaps['r3'], {'r3', 'r4'})
+
+    def test_timeout(self):
+        kwargs = dict(self.kwargs, patience=60)
+        with self.locker.lock(**kwargs):
+            with self.assertRaises(core.LockTimeout):
+                with self.locker.lock(timeout=0.01, **kwargs):
+                    pass
+            with self.assertRaises(core.LockTimeout):
+                with self.locker.lock(blocking=False, **kwargs):
+                    pass
+            with self.assertRaises(ValueError):
+                with self.locker.lock(timeout=1, blocking=False, **kwargs):
+                    pass
+
+            # a waiting user is not held up by the abandoned numbers
+            thread = threading.Thread(target=self.lock_verify, args=(0,))
+            thread.start()
+        start = time.time()
+        thread.join()
+        self.assertLess(time.time() - start, 1)
+
+    def test_fast(self):
+        client = self.locker.client
+        keys = core.Keys(self.resource)
+        kwargs = dict(self.kwargs, patience=60)
+
+        # uncontended, no number is drawn
+        number = int(client.get(keys.dispenser) or 0)
+        with self.locker.lock(mode='fast', **kwargs):
+            self.assertIsNotNone(client.get(keys.fast))
+        self.assertIsNone(client.get(keys.fast))
+        self.assertEqual(int(client.get(keys.dispenser)), number)
+
+        # contended, fast and queueing users take turns
+        order = []
+
+        def lock(name, mode):
+            with self.locker.lock(mode=mode, **kwargs):
+                order.append(name)
+                time.sleep(0.01)
+                order.append(name)
+
+        threads = [threading.Thread(target=lock, args=(name, mode))
+                   for name, mode in enumerate(['fast', 'queue'] * 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order[::2], order[1::2])  # no overlaps
+        self.assertEqual(len(order), 16)
+
+        with self.assertRaises(ValueError):
+            with self.locker.lock(mode='fast', slots=2, **kwargs):
+                pass
+
+    def test_coalesce(self):
+        locker = core.Locker(host=HOST, coalesce=3)
+        client = locker.client
+        keys = core.Keys(self.resource)
+        kwargs = dict(self.kwargs, patience=60)
+        order = []
+
+        def lock(name):
+            with locker.lock(**kwargs):
+                order.append(name)
+                time.sleep(0.01)
+                order.append(name)
+
+        # local users share numbers, at most four users per number
+        number = int(client.get(keys.dispenser) or 0)
+        with locker.lock(**kwargs):
+            threads = [threading.Thread(target=lock, args=(name,))
+                       for name in range(8)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.01)
+            with self.assertRaises(core.LockTimeout):
+                with locker.lock(blocking=False, **kwargs):
+                    pass
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order[::2], order[1::2])  # no overlaps
+        self.assertEqual(len(order), 16)
+        self.assertEqual(int(client.get(keys.dispenser)) - number, 3)
+        self.assertFalse(locker.locals)  # idle locals are gone
+
+    def test_reentrant(self):
+        locker = core.Locker(host=HOST, reentrant=True)
+        client = locker.client
+        keys = core.Keys(self.resource)
+        kwargs = dict(self.kwargs, patience=60)
+        errors = []
+
+        def lock():
+            try:
+                with locker.lock(blocking=False, **kwargs):
+                    pass
+            except core.LockTimeout as error:
+                errors.append(error)
+
+        # nested locks by the same thread do not draw numbers
+        with locker.lock(**kwargs):
+            number = int(client.get(keys.dispenser))
+            with locker.lock(**kwargs):
+                with locker.lock_many([self.resource]):
+                    pass
+                thread = threading.Thread(target=lock)
+                thread.start()
+                thread.join()
+            self.assertTrue(locker.holds(self.resource))
+            self.assertEqual(int(client.get(keys.dispenser)), number + 1)
+        self.assertFalse(locker.holds(self.resource))
+        self.assertEqual(len(errors), 1)  # other threads still wait
+
+    def test_events(self):
+        client = self.locker.client
+        keys = core.Keys(self.resource)
+        channel = keys.external
+        subscription = core.Subscription(client, channel)
+        subscription.listen()  # the subscribe message
+
+        # nothing is published without errors
+        locker = core.Locker(host=HOST, events='errors')
+        with locker.lock(**self.kwargs):
+            pass
+        self.assertIsNone(subscription.listen(timeout=0.01))
+        number = int(client.get(keys.dispenser))
+
+        # events go to a sink
+        events = []
+        locker = core.Locker(host=HOST, events=lambda *e: events.append(e))
+        with locker.lock(**self.kwargs):
+            pass
+        expected = [
+            (self.resource, '{} assigned to "test_label"'.format(number + 1)),
+            (self.resource, '{} started'.format(number + 1)),
+            (self.resource, '{} completed by "test_label"'.format(number + 1)),
+        ]
+        self.assertEqual(events, expected)
+
+        # or are published in batches
+        locker = core.Locker(host=HOST, events='batched')
+        with locker.lock(**self.kwargs):
+            pass
+        messages = [subscription.listen(timeout=1)['data'] for _ in range(3)]
+        expected = 'test_resource: {} completed by "test_label"'
+        self.assertEqual(messages[2], expected.format(number + 2))
+        subscription.close()
+
+        with self.assertRaises(ValueError):
+            core.Locker(host=HOST, events='some')
+
+    def test_batcher(self):
+        client = redis.Redis(host=HOST, decode_responses=True)
+        channel = core.Keys(self.resource).external
+        subscription = core.Subscription(client, channel)
+        subscription.listen()  # the subscribe message
+        batcher = core.Batcher(client, backlog=2)
+        pipeline = client.pipeline
+
+        def fail(**kwargs):
+            client.pipeline = pipeline
+            raise redis.ConnectionError()
+
+        # a failed batch is dropped
+        with self.assertLogs('turn.core', level='ERROR'):
+            client.pipeline = fail
+            batcher(self.resource, 'a')
+            time.sleep(0.1)
+
+        # the oldest events beyond the backlog are dropped, too
+        for text in 'bcd':
+            batcher(self.resource, text)
+        messages = [subscription.listen(timeout=2)['data'] for _ in range(2)]
+        expected = ['test_resource: c', 'test_resource: d']
+        self.assertEqual(messages, expected)
+        subscription.close()
+
+    def test_lock_many(self):
+        guard = threading.Lock()
+        active = set()
+        overlaps = []
+        resources = [self.resource, self.resource + '_other']
+
+        def lock(resources):
+            kwargs = dict(self.kwargs, patience=60)
+            del kwargs['resource']
+            with self.locker.lock_many(resources, **kwargs):
+                with guard:
+                    overlaps.append(active.intersection(resources))
+                    active.update(resources)
+                time.sleep(0.01)
+                with guard:
+                    active.difference_update(resources)
+
+        # opposite orders and single resources do not deadlock
+        users = [resources, resources[::-1], resources[:1], resources[1:]]
+        threads = [threading.Thread(target=lock, args=(user,))
+                   for user in users * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlaps, [set()] * len(threads))
+        tools.reset(host=HOST, resources=resources[1:])
+
+    def test_idle(self):
+        client = self.locker.client
+        keys = core.Keys(self.resource)
+        locker = core.Locker(host=HOST, idle=60)
+
+        # the keys of a queue expire only while nobody uses it
+        with locker.lock(**self.kwargs):
+            self.assertEqual(client.ttl(keys.dispenser), -1)
+        self.assertGreater(client.ttl(keys.dispenser), 0)
+        self.assertGreater(client.ttl(keys.indicator), 0)
+        with locker.lock(mode='fast', **self.kwargs):
+            self.assertEqual(client.ttl(keys.dispenser), -1)
+
+        # users of lockers without idle keep them, too
+        with self.locker.lock(**self.kwargs):
+            self.assertEqual(client.ttl(keys.dispenser), -1)
+        self.assertEqual(client.ttl(keys.dispenser), -1)
+
+    def test_striped(self):
+        client = self.locker.client
+        locker = core.StripedLocker(host=HOST, stripes=1, name='test_stripe')
+        stripe = locker.stripe(self.resource)
+        self.assertEqual(stripe, 'test_stripe:0')
+
+        def lock():
+            kwargs = dict(self.kwargs, resource=self.resource + '_other')
+            with locker.lock(**kwargs):
+                pass
+
+        # other resources collide on the single stripe
+        with locker.lock(**self.kwargs):
+            self.assertTrue(client.exists(core.Keys(stripe).dispenser))
+            self.assertFalse(client.exists(core.Keys(self.resource).index))
+            thread = threading.Thread(target=lock)
+            thread.start()
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual(locker.collision_rate(), 0.5)
+        self.assertEqual(core.get_stripes(users=100, rate=0.01), 9851)
+        self.assertEqual(core.get_stripes(users=2, rate=0.5), 2)
+        self.assertEqual(core.get_stripes(users=1, rate=0.5), 1)
+        for rate in (-0.5, 0, 1, 1.5):
+            with self.assertRaises(ValueError):
+                core.get_stripes(users=100, rate=rate)
+        tools.reset(host=HOST, resources=[stripe])
+
+    def test_metrics(self):
+        measurements = []
+        locker = core.Locker(host=HOST, events='none',
+                             metrics=lambda *m: measurements.append(m))
+        with locker.lock(**self.kwargs):
+            pass
+        names = [(r, n) for r, n, v in measurements]
+        expected = [(self.resource, 'wait'),
+                    (self.resource, 'hold'),
+                    (self.resource, 'commands')]
+        self.assertEqual(names, expected)
+        self.assertEqual(measurements[2][2], 2)  # draw and release
+
+        # users that start right away do not subscribe
+        def subscribes():
+            stats = locker.client.info('commandstats')
+            return stats.get('cmdstat_subscribe', {}).get('calls', 0)
+
+        calls = subscribes()
+        with locker.lock(**self.kwargs):
+            pass
+        self.assertEqual(subscribes(), calls)
+
+        # waiting users subscribe and check before waiting
+        def lock():
+            with locker.lock(**dict(self.kwargs, patience=60)):
+                pass
+
+        del measurements[:]
+        with self.locker.lock(**self.kwargs):
+            thread = threading.Thread(target=lock)
+            thread.start()
+            time.sleep(0.05)
+        thread.join()
+        self.assertEqual(measurements[-1][2], 4)  # and draw and release
+
+        # collected per resource
+        collector = metrics.Collector(buckets=[0.5, 1])
+        collector(self.resource, 'wait', 0.5)
+        collector(self.resource, 'wait', 2)
+        collector(self.resource, 'bumps', 1)
+        lines = collector.expose().splitlines()
+        self.assertIn('turn_wait_seconds_bucket'
+                      '{le="0.5",resource="test_resource"} 1', lines)
+        self.assertIn('turn_wait_seconds_bucket'
+                      '{le="+Inf",resource="test_resource"} 2', lines)
+        self.assertIn('turn_wait_seconds_count'
+                      '{resource="test_resource"} 2', lines)
+        self.assertIn('turn_bumps_total{resource="test_resource"} 1', lines)
+
+    def test_keys_tagged(self):
+        keys = core.Keys(self.resource, tagged=True)
+        self.assertEqual(keys.dispenser, 'turn:{test_resource}:dispenser')
+        self.assertEqual(keys.key(3), 'turn:{test_resource}:serial:3')
+        self.assertEqual(keys.number(keys.key(3)), 3)
+        self.assertIsNone(keys.registry)
+        self.assertEqual(core.Keys.untag('{test_resource}'), self.resource)
+        self.assertEqual(core.Keys.untag(self.resource), self.resource)
+
     def test_reset_dead_queue(self):
         self.assertRaises(RuntimeError, self.lock_and_crash)
         tools.reset(host=HOST, resources=[self.resource])
@@ -126,6 +665,180 @@ class TestCore(TestBase):
         self.cycle()
 
 
+class TestAio(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.resource = 'test_resource_aio'
+        self.locker = aio.AsyncLocker(host=HOST)
+        self.kwargs = {'patience': 0.01,
+                       'label': 'test_label',
+                       'resource': self.resource}
+        self.order = []
+
+    async def asyncTearDown(self):
+        await self.locker.close()
+        tools.reset(host=HOST, resources=[self.resource])
+
+    async def lock(self, name):
+        async with self.locker.lock(**self.kwargs):
+            self.order.append(name)
+            await asyncio.sleep(0.01)
+            self.order.append(name)
+
+    async def lock_and_crash(self):
+        async with self.locker.lock(**self.kwargs):
+            raise RuntimeError()
+
+    async def lock_and_give_up(self):
+        async with self.locker.lock(blocking=False, **self.kwargs):
+            pass
+
+    async def test_lock(self):
+        await asyncio.gather(*(self.lock(name) for name in 'abc'))
+        self.assertEqual(self.order[::2], self.order[1::2])  # no overlaps
+        self.assertEqual(sorted(self.order[::2]), ['a', 'b', 'c'])
+
+    async def test_crash(self):
+        with self.assertRaises(RuntimeError):
+            await self.lock_and_crash()
+        await self.lock('a')  # bumps past the crashed number
+        self.assertEqual(self.order, ['a', 'a'])
+
+    async def test_bump_without_index(self):
+        with self.assertRaises(RuntimeError):
+            await self.lock_and_crash()
+        queue = aio.Queue(client=self.locker.client,
+                          resource=self.resource,
+                          heartbeat=self.locker.heartbeat,
+                          dispatcher=self.locker.dispatcher,
+                          scripts=self.locker.scripts)
+        await self.locker.client.delete(queue.keys.index)
+        self.assertEqual(await queue.bump(), 2)
+        await queue.close()
+
+    async def test_handoff(self):
+        await self.locker.close()
+        self.locker = aio.AsyncLocker(host=HOST, handoff=True)
+        await asyncio.gather(*(self.lock(name) for name in 'abc'))
+        self.assertEqual(self.order[::2], self.order[1::2])  # no overlaps
+
+    async def test_slots(self):
+        active = []
+        peaks = []
+
+        async def lock():
+            async with self.locker.lock(slots=2, **self.kwargs):
+                active.append(None)
+                peaks.append(len(active))
+                await asyncio.sleep(0.01)
+                active.pop()
+
+        await asyncio.gather(*(lock() for _ in range(5)))
+        self.assertEqual(max(peaks), 2)
+
+    async def test_shared(self):
+        active = []
+        overlaps = []
+
+        async def lock(shared):
+            async with self.locker.lock(shared=shared, **self.kwargs):
+                active.append(shared)
+                await asyncio.sleep(0.01)
+                overlaps.append(list(active))
+                active.remove(shared)
+
+        await asyncio.gather(*(lock(shared) for shared in (1, 1, 0, 1, 1)))
+        self.assertIn([1, 1], overlaps)
+        self.assertIn([0], overlaps)
+
+    async def test_timeout(self):
+        kwargs = dict(self.kwargs, patience=60)
+        async with self.locker.lock(**kwargs):
+            with self.assertRaises(core.LockTimeout):
+                async with self.locker.lock(timeout=0.01, **kwargs):
+                    pass
+            with self.assertRaises(core.LockTimeout):
+                async with self.locker.lock_many([self.resource],
+                                                 blocking=False):
+                    pass
+        await asyncio.wait_for(self.lock('a'), 1)  # not held up
+
+    async def test_fast(self):
+        async def lock(name, mode):
+            async with self.locker.lock(mode=mode, **self.kwargs):
+                self.order.append(name)
+                await asyncio.sleep(0.01)
+                self.order.append(name)
+
+        await asyncio.gather(*(lock(name, mode) for name, mode
+                               in zip('abcd', ['fast', 'queue'] * 2)))
+        self.assertEqual(self.order[::2], self.order[1::2])  # no overlaps
+
+    async def test_reentrant(self):
+        await self.locker.close()
+        self.locker = aio.AsyncLocker(host=HOST, reentrant=True)
+        async with self.locker.lock(**self.kwargs):
+            async with self.locker.lock(**self.kwargs):
+                self.assertTrue(self.locker.holds(self.resource))
+            with self.assertRaises(core.LockTimeout):
+                await asyncio.create_task(self.lock_and_give_up())
+        self.assertFalse(self.locker.holds(self.resource))
+
+    async def test_lock_many(self):
+        resources = [self.resource, self.resource + '_other']
+
+        async def lock(name, resources):
+            kwargs = dict(self.kwargs)
+            del kwargs['resource']
+            async with self.locker.lock_many(resources, **kwargs):
+                self.order.append(name)
+                await asyncio.sleep(0.01)
+                self.order.append(name)
+
+        await asyncio.gather(lock('a', resources), lock('b', resources[::-1]))
+        self.assertEqual(self.order[::2], self.order[1::2])  # no overlaps
+        tools.reset(host=HOST, resources=resources[1:])
+
+    async def test_heartbeat(self):
+        client = self.locker.client
+        heartbeat = self.locker.heartbeat
+        keys = ['test_key_{}'.format(n) for n in range(100)]
+        for key in keys:
+            await heartbeat.add(key=key, label='test_label', expire=2)
+        await asyncio.sleep(1.1)
+        self.assertGreater(await client.pttl(keys[0]), 1000)  # renewed
+        for key in keys:
+            await heartbeat.remove(key)
+        self.assertLess(len(heartbeat.heap), 100)
+        self.assertIsNone(await client.get(keys[0]))
+
+    async def test_dispatcher(self):
+        client = self.locker.client
+        channel = 'test_channel'
+        dispatcher = self.locker.dispatcher
+        listener1 = await dispatcher.subscribe(channel)
+        listener2 = await dispatcher.subscribe(channel)
+        self.assertIsNone(await listener1.listen(timeout=0.01))
+        await client.publish(channel, 'test_message')
+        self.assertEqual((await listener1.listen())['data'], 'test_message')
+        self.assertEqual((await listener2.listen())['data'], 'test_message')
+        await listener1.close()
+        await listener2.close()
+        self.assertFalse(dispatcher.listeners)
+        self.assertFalse(dispatcher.pending)
+
+    async def test_dispatcher_timeout(self):
+        dispatcher = aio.Dispatcher(self.locker.client)
+        dispatcher.timeout = 0.1
+        # acknowledgements never arrive
+        dispatcher.pubsub.get_message = lambda timeout: asyncio.sleep(timeout)
+        with self.assertRaises(redis.TimeoutError):
+            await dispatcher.subscribe('test_channel')
+        self.assertFalse(dispatcher.listeners)
+        self.assertFalse(dispatcher.pending)
+        await dispatcher.close()
+
+
 class TestTools(TestBase):
 
     def setUp(self):
@@ -147,7 +860,67 @@ class TestTools(TestBase):
         self.lock_later()
         self.kill_later()
 
+    # common
+    def test_find_resources(self):
+        client = self.locker.client
+        self.lock()
+        self.assertIn(self.resource, tools.find_resources(client))
+        tools.reset(host=HOST, resources=[self.resource])
+        self.assertNotIn(self.resource, tools.find_resources(client))
+
+    def test_find_resources_scan(self):
+        # a queue of a version of turn that does not register resources
+        client = self.locker.client
+        self.lock()
+        resource = self.resource + '_unregistered'
+        keys = core.Keys(resource)
+        client.mset({keys.dispenser: 0, keys.indicator: 1})
+        self.assertNotIn(resource, tools.find_resources(client))
+
+        # scanning finds and registers it
+        self.assertIn(resource, tools.find_resources(client, scan=True))
+        self.assertIn(resource, tools.find_resources(client))
+        tools.gc(host=HOST, resources=[], scan=True)
+        self.assertFalse(client.exists(keys.dispenser))
+        self.assertNotIn(resource, tools.find_resources(client))
+
+    # gc
+    def test_gc(self):
+        client = self.locker.client
+        resources = [self.resource, self.resource + '_gc']
+        with self.locker.lock(**self.kwargs):
+            tools.gc(host=HOST, resources=resources)
+        self.assertIsNotNone(client.get(core.Keys(self.resource).dispenser))
+        tools.gc(host=HOST, resources=[])
+        self.assertNotIn(self.resource, tools.find_resources(client))
+        expected = 'Collected 1 of 2 queue(s).\n'
+        self.assertEqual(sys.stdout.getvalue().split('\n')[0] + '\n',
+                         expected)
+
+    def test_gc_leftovers(self):
+        # keys that outlive the dispenser of a queue are collected, too
+        client = self.locker.client
+        keys = core.Keys(self.resource)
+        client.xadd(keys.events, {'event': 'test'})
+        client.set(keys.fast, 'test')
+        client.delete(keys.dispenser)
+        tools.gc(host=HOST, resources=[self.resource])
+        self.assertFalse(client.exists(keys.events, keys.fast))
+
     # follow
+    def test_gc_cluster(self):
+        client = mock.Mock(spec=redis.RedisCluster)
+        script = client.register_script.return_value
+        script.return_value = 1
+        with mock.patch.object(tools, 'get_client', return_value=client):
+            tools.gc(host=HOST, resources=['test_a', 'test_b'])
+
+        # scripts are called by the cluster client, which loads them if needed
+        client.pipeline.assert_not_called()
+        self.assertEqual(script.call_count, 2)
+        self.assertNotIn('client', script.call_args.kwargs)
+        self.assertIn('Collected 2 of 2 queue(s).', sys.stdout.getvalue())
+
     def test_follow(self):
         thread = threading.Thread(target=self.lock_and_kill_later)
         thread.start()
@@ -161,6 +934,50 @@ class TestTools(TestBase):
         )
         self.assertEqual(sys.stdout.getvalue(), expected)
 
+    def test_follow_pattern(self):
+        # the queue does not exist yet when following starts
+        thread = threading.Thread(target=self.lock_and_kill_later)
+        thread.start()
+        tools.follow(host=HOST, resources=['test_res*'], json=True)
+        thread.join()
+        lines = [json.loads(line)
+                 for line in sys.stdout.getvalue().splitlines()]
+        self.assertEqual(lines[0], {'resource': 'test_resource',
+                                    'event': '1 assigned to "test_label"'})
+        self.assertEqual(len(lines), 4)
+
+    def test_follow_stream(self):
+        # events are kept, so they can be followed afterwards
+        locker = core.Locker(host=HOST, stream=100)
+        with locker.lock(**self.kwargs):
+            pass
+        thread = threading.Thread(target=self.kill_later)
+        thread.start()
+        # resources without wildcards are not looked for
+        with mock.patch.object(tools, 'find_resources') as find_resources:
+            tools.follow(host=HOST, resources=[self.resource], stream=True)
+        find_resources.assert_not_called()
+        thread.join()
+        locker.client.delete(core.Keys(self.resource).events)
+        expected = (
+            'test_resource: 1 assigned to "test_label"\n'
+            'test_resource: 1 started\n'
+            'test_resource: 1 completed by "test_label"\n'
+            'test_resource: 2 granted\n'
+        )
+        self.assertEqual(sys.stdout.getvalue(), expected)
+
+    def test_follow_stream_pattern(self):
+        locker = core.Locker(host=HOST, stream=100)
+        with locker.lock(**self.kwargs):
+            pass
+        thread = threading.Thread(target=self.kill_later)
+        thread.start()
+        tools.follow(host=HOST, resources=['test_res*'], stream=True)
+        thread.join()
+        locker.client.delete(core.Keys(self.resource).events)
+        self.assertIn('test_resource: ', sys.stdout.getvalue())
+
     def test_follow_any(self):
         self.lock()  # there must be something to follow
         thread = threading.Thread(target=self.kill_later)
@@ -199,15 +1016,75 @@ class TestTools(TestBase):
         tools.lock(host=HOST, resources=[])
 
     def test_lock_many(self):
-        os.fork, os_fork = lambda: 1, os.fork  # patch fork
-
         resources = [self.resource, self.resource]
-        thread = threading.Thread(target=self.kill_later)
+
+        def kill_when_locked():
+            # interrupt the lock tool only once it holds the lock
+            while 'locked' not in sys.stdout.getvalue():
+                time.sleep(0.01)
+            self.kill()
+
+        thread = threading.Thread(target=kill_when_locked)
         thread.start()
         tools.lock(host=HOST, resources=resources)
         thread.join()
 
-        os.fork = os_fork  # restore fork
+        expected = (
+            'test_resource: acquiring\n'
+            'test_resource: locked\n'
+            'test_resource: released\n'
+        )
+        self.assertEqual(sys.stdout.getvalue(), expected)
+
+    # recover
+    def lock_recovered_and_kill(self):
+        with self.locker.lock(resource=self.resource, patience=60):
+            pass
+        self.kill()
+
+    def test_recover(self):
+        # a user that dies without revoking its presence
+        client = self.locker.client
+        queue = core.Queue(client=client, resource=self.resource)
+        args = queue.script_args + [self.label, 1, 1, 0]
+        number = queue.scripts.draw(keys=queue.script_keys, args=args)[0]
+
+        # unrelated expiring keys
+        client.set('test_key', self.label, px=100)
+        client.set(core.Keys('test_other').key(1), self.label, px=100)
+
+        start = time.time()
+        thread = threading.Thread(target=self.lock_recovered_and_kill)
+        thread.start()
+        tools.recover(host=HOST, resources=[self.resource])
+        thread.join()
+
+        self.assertLess(time.time() - start, 5)  # well within patience
+        expected = 'test_resource: {} expired\n'.format(number)
+        self.assertEqual(sys.stdout.getvalue(), expected)
+
+    def test_recover_config(self):
+        # where CONFIG is disabled, the operator is asked to configure redis
+        client = mock.Mock(spec=redis.Redis)
+        client.config_get.side_effect = redis.ResponseError('unknown command')
+        with mock.patch.object(tools, 'get_client', return_value=client):
+            self.assertEqual(tools.recover(host=HOST, resources=[]), 1)
+        self.assertIn('notify-keyspace-events', sys.stdout.getvalue())
+        client.pubsub.assert_not_called()
+
+    def test_recover_fast(self):
+        # a user in fast mode that dies without giving the resource back
+        client = self.locker.client
+        keys = core.Keys(self.resource)
+        client.set(keys.fast, 'token:' + self.label, px=300)
+
+        thread = threading.Thread(target=self.lock_recovered_and_kill)
+        thread.start()
+        tools.recover(host=HOST, resources=[self.resource])
+        thread.join()
+
+        expected = 'test_resource: fast expired\n'
+        self.assertEqual(sys.stdout.getvalue(), expected)
 
     # reset
     def test_reset_success(self):
@@ -215,6 +1092,13 @@ class TestTools(TestBase):
         tools.reset(host=HOST, resources=[self.resource])
         self.assertEqual(sys.stdout.getvalue(), '')
 
+    def test_reset_stream(self):
+        locker = core.Locker(host=HOST, stream=100)
+        with locker.lock(**self.kwargs):
+            pass
+        tools.reset(host=HOST, resources=[self.resource])
+        self.assertFalse(locker.client.exists(core.Keys(self.resource).events))
+
     def test_reset_no_queue(self):
         tools.reset(host=HOST, resources=[self.resource])
         expected = 'No such queue: "test_resource".\n'
@@ -229,10 +1113,7 @@ class TestTools(TestBase):
 
     def test_reset_watch(self):
         self.lock()  # as opposed to the no queue case
-        thread = threading.Thread(target=self.lock_later)
-        thread.start()
-        tools.reset(host=HOST, resources=[self.resource], test=True)
-        thread.join()
+        tools.reset(host=HOST, resources=[self.resource], test=self.lock)
         expected = 'Activity detected for "test_resource".\n'
         self.assertEqual(sys.stdout.getvalue(), expected)
 
@@ -260,9 +1141,59 @@ class TestTools(TestBase):
         )
         self.assertEqual(sys.stdout.getvalue(), expected)
 
+    def test_status_json(self):
+        with self.locker.lock(**self.kwargs):
+            tools.status(host=HOST, resources=[self.resource], json=True)
+            tools.status(host=HOST, resources=[], json=True)
+        lines = [json.loads(line)
+                 for line in sys.stdout.getvalue().splitlines()]
+        users = [{'number': 1, 'label': 'test_label'}]
+        self.assertEqual(lines[0], {'resource': 'test_resource',
+                                    'indicator': 1,
+                                    'users': users})
+        self.assertIn({'resource': 'test_resource', 'size': 1}, lines[1:])
+
+    def test_status_stats(self):
+        client = self.locker.client
+        keys = core.Keys(self.resource + '_stats')
+        locker = core.Locker(host=HOST, stats=60)
+        kwargs = dict(self.kwargs, resource=keys.resource)
+        with locker.lock(**kwargs):
+            pass
+        with self.assertRaises(RuntimeError):
+            with locker.lock(**kwargs):
+                raise RuntimeError()
+        with locker.lock(**kwargs):
+            pass  # bumps past the crashed number
+        # the oldest statistics present, from nine minutes ago
+        now = int(client.time()[0]) // 60
+        client.hset(keys.stats(now - 9), 'completed', 3)
+        client.expire(keys.stats(now - 9), 60)
+        tools.status(host=HOST, resources=[keys.resource], stats=True,
+                     json=True)
+        summary = json.loads(sys.stdout.getvalue())
+        # five locks over ten minutes, or eleven when the minute turns
+        self.assertIn(summary['rate'], (round(5 / 10, 2), round(5 / 11, 2)))
+        self.assertEqual(summary['crashed'], 1)
+        self.assertGreater(summary['bumps'], 0)
+        self.assertIsNotNone(summary['hold']['p95'])
+        for key in client.keys(keys.stats('*')):
+            self.assertGreater(client.ttl(key), 0)
+            client.delete(key)
+        tools.reset(host=HOST, resources=[keys.resource])
+
     def test_status_none(self):
         tools.status(host=HOST, resources=self.resource)
 
+    def test_status_fast(self):
+        # a user in fast mode holds the resource without a number
+        with self.locker.lock(mode='fast', **self.kwargs):
+            tools.status(host=HOST, resources=[self.resource])
+            tools.status(host=HOST, resources=[])
+        lines = sys.stdout.getvalue().split('\n')
+        self.assertIn('test_label' + 46 * ' ' + 'fast', lines)
+        self.assertIn('test_resource' + 46 * ' ' + '1', lines)
+
     def test_status_any(self):
         with self.locker.lock(**self.kwargs):
             tools.status(host=HOST, resources=[])
@@ -270,6 +1201,112 @@ class TestTools(TestBase):
         self.assertIn(line, sys.stdout.getvalue().split('\n'))
 
 
+class TestCluster(TestBase):
+    """ Cluster code paths, with a single server posing as a cluster. """
+
+    def setUp(self):
+        # keys are hash tagged and resources are not registered
+        for module in (core, aio, tools):
+            patcher = mock.patch.object(module, 'is_cluster',
+                                        return_value=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        # swap stdout with fresh StringIO
+        self.stdout, sys.stdout = sys.stdout, io.StringIO()
+
+    def tearDown(self):
+        # swap back
+        self.stdout, sys.stdout = sys.stdout, self.stdout
+
+    def lock_recovered_and_kill(self):
+        with self.locker.lock(resource=self.resource, patience=60):
+            pass
+        self.kill()
+
+    def test_get_nodes(self):
+        client = mock.Mock(spec=redis.RedisCluster)
+        node = mock.Mock(redis_connection=self.locker.client)
+        client.get_primaries.return_value = [node, node]
+        self.assertEqual(tools.get_nodes(client), [self.locker.client] * 2)
+
+    def test_mget(self):
+        client = mock.Mock(spec=redis.RedisCluster)
+        client.mget_nonatomic.return_value = ['1', None]
+        self.assertEqual(tools.mget(client, ['a', 'b']), ['1', None])
+        client.mget_nonatomic.assert_called_once_with(['a', 'b'])
+        client.mget.assert_not_called()
+
+    def test_lock_many(self):
+        client = self.locker.client
+        resources = ['test_resource_b', 'test_resource_a']
+        keys = [core.Keys(r, tagged=True) for r in resources]
+        with self.locker.lock_many(resources, label=self.label):
+            self.assertEqual(client.zcard(keys[0].index), 1)
+            self.assertEqual(client.zcard(keys[1].index), 1)
+            self.assertFalse(client.exists(core.Keys(resources[0]).index))
+        self.assertFalse(client.sismember(core.Keys.RESOURCES, resources[0]))
+        tools.reset(host=HOST, resources=resources)
+        self.assertFalse(client.exists(keys[0].dispenser, keys[1].dispenser))
+
+    def test_recover(self):
+        # a user that dies without revoking its presence
+        client = self.locker.client
+        queue = core.Queue(client=client, resource=self.resource)
+        args = queue.script_args + [self.label, 1, 1, 0]
+        number = queue.scripts.draw(keys=queue.script_keys, args=args)[0]
+
+        # a node that stays silent, besides the actual one
+        node = mock.Mock()
+        node.config_get.return_value = {'notify-keyspace-events': 'Ex'}
+        node.pubsub.return_value.get_message.return_value = None
+
+        thread = threading.Thread(target=self.lock_recovered_and_kill)
+        thread.start()
+        with mock.patch.object(tools, 'get_nodes',
+                               return_value=[node, client]):
+            tools.recover(host=HOST, resources=[self.resource])
+        thread.join()
+        tools.reset(host=HOST, resources=[self.resource])
+
+        expected = 'test_resource: {} expired\n'.format(number)
+        self.assertEqual(sys.stdout.getvalue(), expected)
+
+    def test_aio(self):
+        locker = aio.AsyncLocker(host=HOST)
+        resources = ['test_resource_b', 'test_resource_a']
+        order = []
+
+        async def lock(name):
+            async with locker.lock_many(resources, patience=60):
+                order.append(name)
+                await asyncio.sleep(0.01)
+                order.append(name)
+
+        async def main():
+            # the waiting user is woken through the pubsub of the dispatcher
+            await asyncio.gather(lock('a'), lock('b'))
+            await locker.close()
+
+        asyncio.run(main())
+        tools.reset(host=HOST, resources=resources)
+        self.assertEqual(order[::2], order[1::2])  # no overlaps
+        self.assertEqual(len(order), 4)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        results = benchmark.run({'host': HOST}, count=8, users=2, depths=[2])
+        json.dumps(results)
+        self.assertEqual(results['threads']['cycles'], 8)
+        self.assertEqual(results['bumps'][0]['depth'], 2)
+        self.assertEqual(results['commands']['none']['round_trips_per_cycle'],
+                         2)
+        client = core.Locker(host=HOST).client
+        self.assertFalse(client.keys('turn:benchmark_*'))
+
+
 class TestConsole(unittest.TestCase):
 
     def test_console(self):
@@ -5,84 +5,453 @@ This module provides a number of (commandline) tools to manipulate or
 inspect the state of the turn system.
 """
 
+import collections
+import fnmatch
+import itertools
+import json
 import re
-import os
 import redis
 import signal
+import sys
 import time
 
 from .core import Keys
 from .core import Locker
 from .core import Queue
 from .core import Subscription
+from .core import is_cluster
+from .scripts import Scripts
 
 SEPARATOR = 60 * '-'
+BATCH = 1000  # number of resources to read in a single round trip
+MINUTES = 60  # minutes of statistics summarized by the status command
+DISCOVER = 10  # seconds between looking for resources to follow streams of
 
 
 # common
-def find_resources(client):
-    """ Detect dispensers and return corresponding resources. """
+def get_client(kwargs):
+    """ Return Redis client, or Redis Cluster client if cluster is set. """
+    if kwargs.pop('cluster', False):
+        kwargs.pop('db', None)  # a cluster only has database zero
+        return redis.RedisCluster(decode_responses=True, **kwargs)
+    return redis.Redis(decode_responses=True, **kwargs)
+
+
+def get_keys(client, resource):
+    """ Return keys for resource, hash tagged for a cluster. """
+    return Keys(resource, tagged=is_cluster(client))
+
+
+def get_nodes(client):
+    """ Return a client per primary node of a cluster, or client itself. """
+    if is_cluster(client):
+        return [node.redis_connection for node in client.get_primaries()]
+    return [client]
+
+
+def mget(client, keys):
+    """ Return values for keys, which may map to any slot of a cluster. """
+    if not keys:
+        return []
+    if is_cluster(client):
+        return client.mget_nonatomic(keys)
+    return client.mget(keys)
+
+
+def find_resources(client, scan=False):
+    """
+    Return registered resources, and detect dispensers and add corresponding
+    resources when no resources are registered or scan is set. Detected
+    resources are registered, so that they are found without scanning later.
+
+    On a cluster, resources are not registered and the dispensers are
+    detected on all primary nodes.
+    """
+    cluster = is_cluster(client)
+    resources = [] if cluster else list(client.sscan_iter(Keys.RESOURCES))
+    if resources and not scan:
+        return resources
+
     wildcard = Keys.DISPENSER.format('*')
     pattern = re.compile(Keys.DISPENSER.format('(.*)'))
-    return [pattern.match(d).group(1)
-            for d in client.scan_iter(wildcard)]
+    registered = set(resources)
+    detected = [Keys.untag(pattern.match(d).group(1))
+                for d in client.scan_iter(wildcard)]
+    detected = [r for r in detected if r not in registered]
+    if not cluster:
+        for batch in batches(detected):
+            client.sadd(Keys.RESOURCES, *batch)
+    return resources + detected
+
+
+def batches(iterable, size=BATCH):
+    """ Return lists of at most size items from iterable. """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def read_details(client, resources):
+    """
+    Return indicator and present users per resource, reading all resources
+    in two round trips. A user holding the resource in fast mode comes first,
+    without a number.
+    """
+    keys = [get_keys(client, resource) for resource in resources]
+    with client.pipeline(transaction=False) as pipe:
+        for k in keys:
+            pipe.get(k.indicator)
+            pipe.zrange(k.index, 0, -1)
+            pipe.get(k.fast)
+        values = pipe.execute()
+    indicators, indices, fasts = values[::3], values[1::3], values[2::3]
+
+    # labels of all indexed numbers at once
+    serials = [k.key(n) for k, numbers in zip(keys, indices) for n in numbers]
+    labels = iter(mget(client, serials))
+
+    for resource, indicator, numbers, fast in zip(
+            resources, indicators, indices, fasts):
+        users = [(int(number), label)
+                 for number, label in zip(numbers, labels)
+                 if label is not None]
+        if fast is not None:
+            users.insert(0, (None, fast.partition(':')[2]))
+        if indicator is not None:
+            indicator = int(indicator)
+        yield resource, indicator, users
+
+
+def read_sizes(client, resources):
+    """
+    Return queue size and resource pairs, in a single round trip. A user
+    holding the resource in fast mode counts as one.
+    """
+    keys = [get_keys(client, resource) for resource in resources]
+    dispensers = [k.dispenser for k in keys]
+    indicators = [k.indicator for k in keys]
+    fasts = [k.fast for k in keys]
+    values = mget(client, dispensers + indicators + fasts)
+    size = len(resources)
+    combinations = zip(values[:size], values[size:2 * size], values[2 * size:])
+    for resource, (dispenser, indicator, fast) in zip(resources, combinations):
+        if dispenser is None or indicator is None:
+            continue  # reset in the mean time
+        taken = 0 if fast is None else 1
+        yield int(dispenser) - int(indicator) + 1 + taken, resource
+
+
+def read_stats(client, resources, minutes=MINUTES):
+    """
+    Return summaries of the statistics of the last minutes per resource,
+    reading all resources in a single round trip after reading the time.
+    Rates cover the minutes from the oldest statistics present up to now.
+    """
+    now = int(client.time()[0]) // 60
+    keys = [get_keys(client, resource) for resource in resources]
+    with client.pipeline(transaction=False) as pipe:
+        for k in keys:
+            for minute in range(now - minutes + 1, now + 1):
+                pipe.hgetall(k.stats(minute))
+        values = pipe.execute()
+
+    for offset, resource in zip(range(0, len(values), minutes), resources):
+        totals = collections.Counter()
+        covered = 0
+        for index, value in enumerate(values[offset:offset + minutes]):
+            if value and not covered:
+                covered = minutes - index  # statistics may expire sooner
+            totals.update({f: int(v) for f, v in value.items()})
+        if totals:
+            yield resource, summarize(totals, covered)
+
+
+def summarize(totals, minutes):
+    """
+    Return locks per minute, mean and 95th percentile of wait and hold
+    times in seconds and the other counts from statistics summed over
+    minutes. Percentiles are the upper bounds of their buckets.
+    """
+    summary = {'rate': round(totals['completed'] / minutes, 2)}
+    for name in ('wait', 'hold'):
+        pattern = re.compile(name + r':([0-9]+)$')
+        buckets = []
+        for field, n in totals.items():
+            match = pattern.match(field)
+            if match:
+                buckets.append((int(match.group(1)), n))
+        buckets.sort()
+        count = sum(n for exponent, n in buckets)
+        mean = p95 = None
+        if count:
+            mean = round(totals[name + ':sum'] / count / 1000, 3)
+            running = 0
+            for exponent, n in buckets:
+                running += n
+                if running >= 0.95 * count:
+                    p95 = 2 ** exponent / 1000
+                    break
+        summary[name] = {'mean': mean, 'p95': p95}
+    for name in ('abandoned', 'crashed', 'bumps'):
+        summary[name] = totals[name]
+    return summary
+
+
+def print_stats(client, resources, as_json):
+    """ Print statistics per resource, as text or as JSON lines. """
+    template = '{:<26}{:>9}{:>9}{:>9}{:>9}{:>9}{:>8}{:>8}{:>8}'
+    if not as_json:
+        header = template.format('Resource', 'Locks/m', 'Wait', 'Wait95',
+                                 'Hold', 'Hold95', 'Left', 'Crashed', 'Bumps')
+        print(header)
+        print(len(header) * '-')
+    for batch in batches(resources):
+        for resource, summary in read_stats(client, batch):
+            if as_json:
+                print(json.dumps(dict(summary, resource=resource)))
+                continue
+            wait, hold = summary['wait'], summary['hold']
+            times = [wait['mean'], wait['p95'], hold['mean'], hold['p95']]
+            times = ['-' if t is None else t for t in times]
+            print(template.format(resource, summary['rate'], *times,
+                                  summary['abandoned'], summary['crashed'],
+                                  summary['bumps']))
+        sys.stdout.flush()
 
 
 # tools
-def follow(resources, **kwargs):
-    """ Follow publications involved with resources. """
-    # subscribe
-    client = redis.Redis(decode_responses=True, **kwargs)
-    resources = resources if resources else find_resources(client)
-    channels = [Keys.EXTERNAL.format(resource) for resource in resources]
-    if resources:
-        subscription = Subscription(client, *channels)
+def follow(resources, *args, **kwargs):
+    """
+    Follow publications involved with resources, including queues that come
+    into existence while following. Resources may contain glob patterns.
+    """
+    as_json = kwargs.pop('json', False)
+    stream = kwargs.pop('stream', False)
+    client = get_client(kwargs)
+    if stream:
+        return follow_streams(client, resources, as_json)
+    pattern = re.compile(Keys.EXTERNAL.format('(.*)') + '$')
 
-    # listen
-    while resources:
+    # subscribe to patterns, so that new queues are followed, too
+    patterns = [get_keys(client, r).external for r in resources or ['*']]
+    pubsub = client.pubsub()
+    pubsub.psubscribe(*patterns)
+
+    # listen, writing buffered lines whenever no more messages are pending
+    lines = []
+    while True:
         try:
-            message = subscription.listen()
-            if message['type'] == 'message':
-                print(message['data'])
+            message = pubsub.get_message(timeout=0 if lines else None)
+            if message is None or len(lines) >= BATCH:
+                sys.stdout.write(''.join(lines))
+                sys.stdout.flush()
+                lines = []
+            if message is None or message['type'] != 'pmessage':
+                continue
+            if as_json:
+                tag = pattern.match(message['channel']).group(1)
+                resource = Keys.untag(tag)
+                event = message['data'][len(resource) + 2:]
+                line = json.dumps({'resource': resource, 'event': event})
+            else:
+                line = message['data']
+            lines.append(line + '\n')
         except KeyboardInterrupt:
             break
 
+    sys.stdout.write(''.join(lines))
+    pubsub.close()
+
+
+def follow_streams(client, resources, as_json):
+    """
+    Print the events in the streams of resources, from the oldest event that
+    is kept on. Resources may be patterns, matched against the registered
+    resources every DISCOVER seconds.
+
+    On a cluster, the streams map to different slots and are read one by one.
+    """
+    cluster = is_cluster(client)
+    patterns = [r for r in resources or ['*'] if re.search(r'[*?[]', r)]
+    pattern = re.compile(Keys.EVENTS.format('(.*)') + '$')
+    # resource => id of last event read
+    ids = {r: '0' for r in resources if r not in patterns}
+    discovered = None  # time of the last look for resources
+
+    while True:
+        try:
+            # pick up streams of matching resources as they are registered
+            if patterns and (discovered is None
+                             or time.time() - discovered > DISCOVER):
+                discovered = time.time()
+                for resource in find_resources(client):
+                    if any(fnmatch.fnmatchcase(resource, p)
+                           for p in patterns):
+                        ids.setdefault(resource, '0')
+            if not ids:
+                time.sleep(1)
+                continue
+
+            # read events in batches
+            streams = {get_keys(client, r).events: i for r, i in ids.items()}
+            if cluster:
+                response = [r
+                            for name, id in streams.items()
+                            for r in client.xread({name: id}, count=BATCH)]
+                if not response:
+                    time.sleep(1)
+            else:
+                response = client.xread(streams, count=BATCH, block=1000)
+            lines = []
+            for name, events in response:
+                resource = Keys.untag(pattern.match(name).group(1))
+                for id, fields in events:
+                    ids[resource] = id
+                    if as_json:
+                        line = json.dumps({'resource': resource,
+                                           'event': fields['event'],
+                                           'id': id})
+                    else:
+                        line = '{}: {}'.format(resource, fields['event'])
+                    lines.append(line + '\n')
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+        except KeyboardInterrupt:
+            break
+
+
+def gc(resources, *args, **kwargs):
+    """
+    Remove the keys of queues that nobody uses, and registered resources
+    whose keys are gone, in pipelined batches.
+
+    On a cluster, pipelines do not load scripts that are missing on a node,
+    so queues are collected one by one.
+    """
+    scan = kwargs.pop('scan', False)
+    client = get_client(kwargs)
+    resources = resources if resources else find_resources(client, scan)
+    scripts = Scripts(client)
+    cluster = is_cluster(client)
+
+    count = 0
+    for batch in batches(resources):
+        queues = [Queue(client=client, resource=resource, scripts=scripts)
+                  for resource in batch]
+        if cluster:
+            values = [scripts.collect(keys=queue.script_keys,
+                                      args=queue.script_args)
+                      for queue in queues]
+        else:
+            with client.pipeline(transaction=False) as pipe:
+                for queue in queues:
+                    scripts.collect(keys=queue.script_keys,
+                                    args=queue.script_args, client=pipe)
+                values = pipe.execute()
+        count += sum(values)
+    print('Collected {} of {} queue(s).'.format(count, len(resources)))
+
 
 def lock(resources, *args, **kwargs):
     """ Lock resources from the command line, for example for maintenance. """
+    scan = kwargs.pop('scan', False)
+    client = get_client(kwargs)
+
     # all resources are locked if nothing is specified
     if not resources:
-        client = redis.Redis(decode_responses=True, **kwargs)
-        resources = find_resources(client)
+        resources = find_resources(client, scan)
 
     if not resources:
         return
 
-    # create one process per pid
-    locker = Locker(**kwargs)
-    while len(resources) > 1:
-        pid = os.fork()
-        resources = resources[:1] if pid else resources[1:]
-
-    # at this point there is only one resource - lock it down
-    resource = resources[0]
+    # lock all resources at once
+    locker = Locker(client=client)
+    resources = sorted(set(resources))
     try:
-        print('{}: acquiring'.format(resource))
-        with locker.lock(resource, label='lock tool'):
-            print('{}: locked'.format(resource))
+        for resource in resources:
+            print('{}: acquiring'.format(resource))
+        with locker.lock_many(resources, label='lock tool'):
+            for resource in resources:
+                print('{}: locked'.format(resource))
             try:
                 signal.pause()
             except KeyboardInterrupt:
-                print('{}: released'.format(resource))
+                for resource in resources:
+                    print('{}: released'.format(resource))
     except KeyboardInterrupt:
-        print('{}: canceled'.format(resource))
+        for resource in resources:
+            print('{}: canceled'.format(resource))
+
+
+def recover(resources, *args, **kwargs):
+    """
+    Bump queues as soon as the presence of one of their users expires, or
+    the resource taken by a user in fast mode.
+
+    On a cluster, every primary node notifies about its own keys only, so
+    the tool subscribes on each of them.
+    """
+    client = get_client(kwargs)
+    channel = '__keyevent@{}__:expired'.format(kwargs.get('db', 0))
+    nodes = get_nodes(client)
+
+    # make sure redis notifies about expired keys
+    for node in nodes:
+        try:
+            events = node.config_get('notify-keyspace-events')
+            events = events.get('notify-keyspace-events', '')
+            if not ('E' in events and ('x' in events or 'A' in events)):
+                node.config_set('notify-keyspace-events', events + 'Ex')
+        except redis.ResponseError as error:
+            print('Configuring notifications failed: {}.'.format(error))
+            print('Set notify-keyspace-events to include "Ex" in the redis '
+                  'configuration and try again.')
+            return 1
+
+    # subscribe
+    subscriptions = [Subscription(node, channel) for node in nodes]
+    timeout = None if len(subscriptions) == 1 else 0.1
+    pattern = re.compile(Keys.NUMBER.format('(.*)', '([0-9]+)') + '$')
+    fast = re.compile(Keys.FAST.format('(.*)') + '$')
+
+    # listen
+    while True:
+        try:
+            for subscription in subscriptions:
+                message = subscription.listen(timeout=timeout)
+                if message is not None and message['type'] == 'message':
+                    break
+            else:
+                continue
+            match = pattern.match(message['data'])
+            if match is not None:
+                tag, number = match.groups()
+            else:
+                # the presence of a user in fast mode
+                match = fast.match(message['data'])
+                if match is None:
+                    continue
+                tag, number = match.group(1), 'fast'
+            resource = Keys.untag(tag)
+            if resources and resource not in resources:
+                continue
+            queue = Queue(client=client, resource=resource)
+            queue.message('Recover tool bumps.')
+            print('{}: {} expired'.format(resource, number))
+            queue.bump()
+        except KeyboardInterrupt:
+            break
 
 
 def reset(resources, *args, **kwargs):
     """ Remove dispensers and indicators for idle resources. """
-    test = kwargs.pop('test', False)
-    client = redis.Redis(decode_responses=True, **kwargs)
-    resources = resources if resources else find_resources(client)
+    test = kwargs.pop('test', None)
+    scan = kwargs.pop('scan', False)
+    client = get_client(kwargs)
+    resources = resources if resources else find_resources(client, scan)
 
     for resource in resources:
         # investigate sequences
@@ -110,9 +479,15 @@ def reset(resources, *args, **kwargs):
             try:
                 pipe.watch(queue.keys.dispenser)
                 if test:
-                    time.sleep(0.02)
+                    test()  # activity while watching, for testing
                 pipe.multi()
-                pipe.delete(queue.keys.dispenser, queue.keys.indicator)
+                pipe.delete(queue.keys.dispenser,
+                            queue.keys.indicator,
+                            queue.keys.index,
+                            queue.keys.exclusive,
+                            queue.keys.events)
+                if queue.keys.registry:
+                    pipe.srem(queue.keys.registry, resource)
                 pipe.execute()
             except redis.WatchError:
                 print('Activity detected for "{}".'.format(resource))
@@ -120,50 +495,62 @@ def reset(resources, *args, **kwargs):
 
 def status(resources, *args, **kwargs):
     """
-    Print status report for zero or more resources.
+    Print status report for zero or more resources, as text or as JSON lines,
+    or the statistics of the last hour if stats is set.
     """
+    as_json = kwargs.pop('json', False)
+    stats = kwargs.pop('stats', False)
+    scan = kwargs.pop('scan', False)
     template = '{:<50}{:>10}'
-    client = redis.Redis(decode_responses=True, **kwargs)
-
-    # resource details
-    for loop, resource in enumerate(resources):
-        # blank between resources
-        if loop:
-            print()
-
-        # strings needed
-        keys = Keys(resource)
-        wildcard = keys.key('*')
-
-        # header
-        template = '{:<50}{:>10}'
-        indicator = client.get(keys.indicator)
-        if indicator is None:
-            continue
-        print(template.format(resource, indicator))
-        print(SEPARATOR)
+    client = get_client(kwargs)
+
+    if stats:
+        resources = resources if resources else find_resources(client, scan)
+        return print_stats(client, resources, as_json)
 
-        # body
-        numbers = sorted([keys.number(key)
-                          for key in client.scan_iter(wildcard)])
-        for number in numbers:
-            label = client.get(keys.key(number))
-            print(template.format(label, number))
+    # resource details, printed batch by batch
+    loop = itertools.count()
+    for batch in batches(resources):
+        for resource, indicator, users in read_details(client, batch):
+            if as_json:
+                if indicator is not None:
+                    print(json.dumps({
+                        'resource': resource,
+                        'indicator': indicator,
+                        'users': [{'number': number, 'label': label}
+                                  for number, label in users],
+                    }))
+                continue
+
+            # blank between resources
+            if next(loop):
+                print()
+
+            # header
+            if indicator is None:
+                continue
+            print(template.format(resource, indicator))
+            print(SEPARATOR)
+
+            # body
+            for number, label in users:
+                print(template.format(label, 'fast' if number is None
+                                      else number))
+        sys.stdout.flush()
 
     if resources:
         return
 
     # show a more general status report for all available queues
-    resources = find_resources(client)
-    if resources:
-        dispensers = (Keys.DISPENSER.format(r) for r in resources)
-        indicators = (Keys.INDICATOR.format(r) for r in resources)
-        combinations = zip(client.mget(dispensers), client.mget(indicators))
-        sizes = (int(dispenser) - int(indicator) + 1
-                 for dispenser, indicator in combinations)
-
+    sizes = [pair
+             for batch in batches(find_resources(client, scan))
+             for pair in read_sizes(client, batch)]
+    if as_json:
+        for size, resource in sorted(sizes, reverse=True):
+            print(json.dumps({'resource': resource, 'size': size}))
+    elif sizes:
         # print sorted results
         print(template.format('Resource', 'Queue size'))
         print(SEPARATOR)
-        for size, resource in sorted(zip(sizes, resources), reverse=True):
+        for size, resource in sorted(sizes, reverse=True):
             print(template.format(resource, size))